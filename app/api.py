@@ -2,6 +2,7 @@ import os
 import re
 import time
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from fastapi import FastAPI
 from fastapi.encoders import jsonable_encoder
 
@@ -12,24 +13,25 @@ from app.utils.utility_fns import make_exp_dir, enumerate_read_files, read_fa
 from app.utils.write_logs import write_input_params
 from app.utils.error_handlers import error_handler_api
 from app.utils.generate_probe_files import ProbeFileGen
-from app.utils.combine_batch_output import combine_output_csvs, combine_output_from_endpoint
+from app.utils.combine_batch_output import combine_output_csvs, combine_output_from_endpoint, amplicon_stats_csvs
 from app.utils.dependency_check import Dependencies
 from app.utils.mapping_ref_checks import check_mapping_ref
 from app.utils.concat_ont import ConcatOnt
 from app.src.preprocess import run_kraken
 from app.src.filter_keep_reads import FilterKeepReads
 from app.src.trim_adapters import run_trim
-from app.src.map_reads_to_ref import run_map
+from app.src.map_reads_to_ref import run_map, index_mapping_ref
 from app.src.generate_counts import run_counts
 from app.src.consensus import Consensus
 from app.src.analysis import Analysis
 from app.src.amplicons import Amplicons
 from app.src.post_filter import run_post_filter
+from app.src.stream_pipeline import run_stream_pipeline
 from app.utils.attempt_imports import import_test
 from app.utils.hash_files import check_infile_hashes
 from app.utils.cleanup import clean_intermediates
 from app.utils.mapping_ref_convert import MappingRefConverter
-from app.utils.api_classes import (Batch_eval_data, E2e_data, Preprocess_data, Filter_keep_reads_data, Amp_e2e_data, Concat_ont_data,
+from app.utils.api_classes import (Batch_eval_data, E2e_data, Preprocess_data, Filter_keep_reads_data, Amp_e2e_data, Amp_batch_data, Concat_ont_data,
                                    Trim_data, Mapping_data, Count_map_data, Analysis_data, Dep_check_data, Amplicon_data,
                                    Post_filter_data, Consensus_data, Convert_probe_data, Bam_workflow_data, Combine_output_data, Convert_mapping_ref_data)
 
@@ -213,6 +215,78 @@ def do_batch(payload, start_with_bam=False):
         return "Batch process task completed with errors. See terminal output for details."
 
 
+@app.post("/batch_amplicons/", tags=["End to end pipelines"])
+async def batch_amplicons(payload: Amp_batch_data) -> str:
+    payload = process_payload(payload)
+    msg = do_amp_batch(payload)
+    return msg
+
+
+def do_amp_batch(payload):
+    '''
+    Amplicon pipeline over every sample folder in DataFolder. The mapping ref is prepared and indexed once, then
+    samples run concurrently, with NThreads split between workers. Per-target read stats are combined across samples.
+    '''
+    st = time.time()
+    payload["BatchName"] = payload["DataFolder"]
+    payload["StartTime"] = st
+    original_exp_name = payload["ExpName"]
+
+    SeqNamesList = [enumerate_read_files(
+        folder, single_ended_reads=payload["SingleEndedReads"], batch_name=payload["BatchName"]) for folder in sorted(os.listdir(payload["BatchName"])) if not folder == "__pycache__" and os.path.isdir(f"{payload['BatchName']}/{folder}")]
+    SeqNamesList = [i for i in SeqNamesList if not i == []]
+    if len(SeqNamesList) == 0:
+        stoperr(f"No files could be detected to analyse. "
+                f"Castanet expects amplicon batch runs to point towards a data folder containing sub-folders for each sample, which should contain only 2 read files each. "
+                f"Please refer to Castanet's readme for more details.")
+
+    '''Index shared mapping ref once, rather than once per sample'''
+    payload["RefIndexLog"] = index_mapping_ref(payload)
+
+    n_workers = max(1, min(int(payload["NThreads"]), len(SeqNamesList)))
+    sample_threads = max(1, int(payload["NThreads"]) // n_workers)
+    end_sec_print(
+        f"INFO: Running {len(SeqNamesList)} amplicon samples, {n_workers} at a time with {sample_threads} threads each")
+
+    sample_payloads = []
+    for SeqNames in SeqNamesList:
+        sample_payload = dict(payload)
+        sample_payload["SeqNames"] = SeqNames
+        sample_payload["ExpDir"] = "/".join(SeqNames[0].split("/")[:-1])
+        sample_payload["ExpName"] = SeqNames[0].split("/")[-3]
+        sample_payload["NThreads"] = sample_threads
+        sample_payloads.append(sample_payload)
+
+    errs = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(run_amp_batch_sample, i): i["ExpName"]
+                   for i in sample_payloads}
+        for future in as_completed(futures):
+            err = future.result()
+            if err:
+                errs.append(futures[future])
+                end_sec_print(
+                    f"REGISTERED ERROR {futures[future]} WITH EXCEPTION: {err}")
+
+    msg = amplicon_stats_csvs({i["ExpName"]: f"{i['SaveDir']}/{i['ExpName']}/amplicon_data/read_statistics.csv" for i in sample_payloads if not i["ExpName"] in errs},
+                              f"{payload['SaveDir']}/{original_exp_name}_read_statistics.csv")
+    end_sec_print(msg)
+    if len(errs) < 1:
+        return f"***\nAmplicon batch complete. Time to complete: {time.time() - st} ({(time.time() - st)/len(SeqNamesList)} per sample)\n{msg}***"
+    else:
+        return f"Amplicon batch process task completed with errors. Failed to process following samples: {errs}. See terminal output for details."
+
+
+def run_amp_batch_sample(payload) -> str:
+    '''Worker for do_amp_batch; returns error message rather than raising, so one bad sample doesn't stop the batch'''
+    try:
+        run_amp_end_to_end(payload)
+        write_input_params(payload)
+        return ""
+    except Exception as ex:
+        return error_handler_api(ex)
+
+
 '''Consumer endpoints'''
 
 
@@ -261,9 +335,7 @@ def run_end_to_end(payload, start_with_bam=False) -> str:
     if not start_with_bam:
         if payload["DoKrakenPrefilter"]:
             run_kraken(payload)
-        do_filter_keep_reads(payload)
-        run_trim(payload)
-        run_map(payload)
+        run_pre_mapping(payload)
     run_counts(payload, start_with_bam)
     run_analysis(payload, start_with_bam)
     if payload["DoConsensus"]:
@@ -282,11 +354,21 @@ def run_amp_end_to_end(payload, start_with_bam=False) -> str:
     if not start_with_bam:
         if payload["DoKrakenPrefilter"]:
             run_kraken(payload)
+        run_pre_mapping(payload)
+    run_amplicons(payload)
+    return "Task complete. See terminal output for details."
+
+
+def run_pre_mapping(payload) -> None:
+    '''Filter, trim and map reads: streamed between stages if StreamPipeline, else via intermediate files'''
+    if payload["StreamPipeline"] and not payload["DebugMode"]:
+        run_stream_pipeline(payload)
+    else:
+        if payload["StreamPipeline"]:
+            logerr("Not streaming filter/trim/map stages (StreamPipeline) as DebugMode is on, so intermediate files are kept.")
         do_filter_keep_reads(payload)
         run_trim(payload)
         run_map(payload)
-    run_amplicons(payload)
-    return "Task complete. See terminal output for details."
 
 
 @app.post("/preprocess/", tags=["Individual pipeline functions"])
@@ -13,11 +13,15 @@ def defaults():
         "RefStem": "data/eval/ref.fa",
         "MappingRefTable": "",
         "Mapper": "bwa",
+        "StreamPipeline": False,
         "SingleEndedReads": True,
         "MatchLength": 40,
         "DoTrimming": True,
         "TrimMinLen": 36,
         "DoKrakenPrefilter": True,
+        "KrakenStream": False,
+        "KmerPrescreen": False,
+        "PrescreenMinKmers": 2,
         "LineageFile": "data/ncbi_lineages_2023-06-15.csv.gz",
         "ExcludeIds": "9606",
         "RetainIds": "",
@@ -26,6 +30,10 @@ def defaults():
         "ConsensusMinD": 10,
         "ConsensusMapQ": 1,
         "ConsensusTrimTerminals": True,
+        "ConsensusRefAlnCacheMB": 1024,
+        "ConsensusMaxDepth": 0,
+        "ConsensusProjection": False,
+        "ConsensusProjectionMaxDivergence": 0.1,
         "GtFile": "",
         "GtOrg": "",
         "KrakenDbDir": "kraken2_human_db/",
@@ -36,6 +44,7 @@ def defaults():
         "PostFilt": False,
         "AdaptP": "data/all_adapters.fa",
         "NThreads": "auto",
+        "IntermediateCompression": False,
         "DebugMode": False
     }
 
@@ -1,10 +1,12 @@
 import os
-import re
-import numpy as np
+import subprocess as sp
 import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import plotly.express as px
 from app.utils.shell_cmds import shell, loginfo, logerr, stoperr
 from app.utils.utility_fns import read_fa
+from app.utils.identity_clustering import cluster_by_identity
 from app.utils.error_handlers import error_handler_cli
 
 '''
@@ -21,24 +23,20 @@ class Amplicons:
         self.delete_softclips = True  # RM < TODO Parameterise
         self.min_amp_len = 40  # RM < TODO Parameterise
         self.do_aln_graphs = True  # RM < TODO Parameterise
-        self.results = {}
+        self.cluster_identity = 0.97  # RM < TODO Parameterise
+        self.cluster_kmer = 11  # RM < TODO Parameterise
+        self.batch_size = 100000  # Reads per vectorised trimming batch
+        self.results, self.total_reads = {}, {}
         self.bam_fname = f"{self.a['SaveDir']}/{self.a['ExpName']}/{self.a['ExpName']}.bam"
         self.amp_folder = f"{self.a['SaveDir']}/{self.a['ExpName']}/amplicon_data/"
         if not os.path.exists(self.amp_folder):
             os.mkdir(self.amp_folder)
 
     def get_tsvs(self):
-        '''Convert bam to readable TSV format and input FASTQ to FASTA'''
-
-        tsv_fname = self.bam_fname.replace(".bam", ".tsv")
+        '''Output consensuses and depth TSV, plot depth per target, then open stream of reads from bam'''
         consensus_fname = self.bam_fname.replace(".bam", "_consensuses.fasta")
         depth_fname = self.bam_fname.replace(".bam", "_depth.tsv")
 
-        out = shell(f"samtools view -F 0x40 {self.bam_fname} > {tsv_fname}",
-                    ret_output=True)
-        error_handler_cli(out.decode("utf-8"), tsv_fname,
-                          "samtools", test_out_f=True, test_f_size=True)
-
         '''Output consensuses. N.b. this ignores MQ so may not be high quality!'''
         out = shell(f"samtools consensus -d 1 --no-use-MQ -a {self.bam_fname} > {consensus_fname}",
                     ret_output=True)
@@ -49,75 +47,79 @@ class Amplicons:
         error_handler_cli(out.decode("utf-8"), depth_fname,
                           "samtools", test_out_f=True, test_f_size=True)
         df = pd.read_csv(depth_fname, sep="\t", names=["target", "pos", "d"])
-        for tar, cnt in df["target"].value_counts().items():
-            tmp = df[df["target"] == tar]
+        for tar, tmp in df.groupby("target", sort=False):
             fig = px.line(tmp, x="pos", y="d", title=f"Consensus coverage, {self.bam_fname.split('/')[-2]}, target {tar}", labels={
                           "d": "Depth", "pos": "Position"})
             fig.write_image(f"{self.bam_fname}".replace(
                 ".bam", f"_coverage_{tar}.png"))
 
-        '''Read in BAM view TSV and FASTAs'''
-        try:
-            df = pd.read_csv(tsv_fname, sep="\t", header=None,
-                             on_bad_lines="skip")
-        except FileNotFoundError:
-            raise FileNotFoundError(f"No file to read for {self.bam_fname}")
-
-        # [seqid, refname, cigar, seq]
-        seqs = df[[0, 2, 5, 9]].values.tolist()
-        read_stats = df[2].value_counts().to_dict()
-
-        return seqs, read_stats
-
-    def crunch(self, seqs):
-        for seq in seqs:
-            self.filt(seq)
+        return self.stream_reads()
+
+    def stream_reads(self):
+        '''Yield batches of reads (second mates and unpaired: -F 0x40 drops first mates, as before) straight from bam, keeping only cols 0 seqid, 2 refname, 5 cigar, 9 seq'''
+        proc = sp.Popen(["samtools", "view", "-F", "0x40", self.bam_fname],
+                        stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+        batch = []
+        for line in proc.stdout:
+            fields = line.split("\t", 10)
+            batch.append([fields[0], fields[2], fields[5], fields[9]])
+            if len(batch) == self.batch_size:
+                yield pd.DataFrame(batch, columns=[0, 2, 5, 9])
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=[0, 2, 5, 9])
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            stoperr(
+                f"Castanet couldn't read alignments from {self.bam_fname}. Samtools error: {err}")
+
+    def crunch(self, batches):
+        read_stats = Counter()
+        for batch in batches:
+            read_stats.update(batch[2].value_counts().to_dict())
+            self.filt(batch)
+        return dict(read_stats)
 
     def remove_char(self, input_string, index):
         first_part = input_string[:index]
         second_part = input_string[index+1:]
         return first_part + second_part
 
-    def filt(self, row):
-        cigar = row[2]
-        seq = str(row[3])
-        cig_parts = [i for i in re.split(
-            '([0-9]+[A-Z])', cigar) if not i == ""]
-        cnt = 0
-        kill_indices = []
-        for part in cig_parts:
-            part_len = int(re.split(r'[A-Z]', part)[0])
-            if "S" in part:
-                kill_indices.append(np.arange(cnt, cnt + part_len))
-            elif "D" in part:
-                continue
-            cnt = cnt + part_len
-
-        ar = np.zeros((len(seq),), dtype=str)
-        for idx, val in enumerate(seq):
-            ar[idx] = val
+    def filt(self, batch):
+        '''Trim a batch of reads (cols: 0 seqid, 2 refname, 5 cigar, 9 seq), add those over min length to results'''
+        seqs = batch[9].astype(str)
         if self.delete_softclips:
-            '''Delete softclips if user enabled this option'''
-            if len(kill_indices) > 1:
-                kill_indices = np.concatenate([i for i in kill_indices])
-            final_seq = "".join(np.delete(ar, kill_indices))
+            '''Delete softclips if user enabled this option: soft clips can only be terminal (inside any hard clips), so slice them off'''
+            cigars = batch[5].astype(str)
+            lead = cigars.str.extract(
+                r"^(?:[0-9]+H)?([0-9]+)S", expand=False).fillna(0).astype(int)
+            trail = cigars.str.extract(
+                r"[0-9]+[MIDNP=X]([0-9]+)S(?:[0-9]+H)?$", expand=False).fillna(0).astype(int)
+            seqs = pd.Series([seq[start:end] for seq, start, end in zip(
+                seqs, lead, seqs.str.len() - trail)], index=batch.index, dtype=str)
+        keep = seqs.str.len() > self.min_amp_len
+        for seqid, ref, seq in zip(batch.loc[keep, 0], batch.loc[keep, 2], seqs[keep]):
+            self.add_read(ref, seqid, seq)
+
+    def add_read(self, ref, seqid, seq):
+        '''Deduplicate on insert: per ref, hashed seq -> [first read id, index of first read, count]'''
+        if not ref in self.results.keys():
+            self.results[ref], self.total_reads[ref] = {}, 0
+        if seq in self.results[ref].keys():
+            self.results[ref][seq][2] += 1
         else:
-            final_seq = "".join(ar)
-        if len(final_seq) > self.min_amp_len:
-            if not row[1] in self.results.keys():
-                self.results[row[1]] = []
-            self.results[row[1]].append([f"{row[1]}_{row[0]}", final_seq])
+            self.results[ref][seq] = [
+                f"{ref}_{seqid}", self.total_reads[ref], 1]
+        self.total_reads[ref] += 1
+
+    def by_abundance(self, ref):
+        '''Unique reads for ref as [seq, first read id, index of first read, count], most abundant first (ties in read order)'''
+        return sorted([[seq] + i for seq, i in self.results[ref].items()], key=lambda x: (-x[3], x[2]))
 
     def stats(self, read_stats):
         '''Save CSV with details of all and unique reads'''
-        total_stats = {}
-        dedupe_stats = {}
-        for ref in self.results.keys():
-            seen = []
-            for seq in self.results[ref]:
-                seen.append(seq[1])
-            total_stats[ref] = len(seen)
-            dedupe_stats[ref] = len(set(seen))
+        total_stats = self.total_reads
+        dedupe_stats = {ref: len(seqs) for ref, seqs in self.results.items()}
 
         all_stats = {}
         # ref: [all reads, dedupe reads]
@@ -131,55 +133,80 @@ class Amplicons:
         df.to_csv(f"{self.amp_folder}/read_statistics.csv")
 
     def save(self):
-        '''Save DEDUPLICATED reads, separately grouped by target'''
+        '''Save DEDUPLICATED reads, separately grouped by target, most abundant first; then align and plot each target concurrently'''
+        aln_jobs = []
         for ref in self.results.keys():
+            uniq_reads = self.by_abundance(ref)
             with open(f"{self.amp_folder}/{ref}.fasta", "w") as f:
-                seen = set()
-                for idx, seq in enumerate(self.results[ref]):
-                    if not seq[1] in seen:
-                        f.write(
-                            f">{ref}_{self.a['ExpName']}_{idx} {seq[0]}\n{seq[1]}\n")
-                    seen.add(seq[1])
+                [f.write(f">{ref}_{self.a['ExpName']}_{i[2]} {i[1]} count={i[3]}\n{i[0]}\n")
+                 for i in uniq_reads]
 
             if self.do_aln_graphs:
                 aln_file = f"{self.amp_folder}/{ref}.fasta"
-                if len(self.results[ref]) > 100:
-                    '''If lots of deduplicated seqs, make a smaller version for alignment plot.'''
-                    logerr(
-                        f"Castanet won't produce an alignment graph for reference {ref} as you have > 100 unique reads, as this would make a massive graph! Trimming to 100 seqs and re-plotting...")
-                    aln_file = f"{self.amp_folder}/TEMP.fasta"
+                if len(uniq_reads) > 100:
+                    '''If lots of deduplicated seqs, collapse near-identical ones and align/plot cluster representatives instead'''
+                    reps = self.cluster_reads(ref, uniq_reads)
+                    if len(reps) > 100:
+                        logerr(
+                            f"Castanet won't produce an alignment graph for reference {ref} as you have > 100 clusters of unique reads, as this would make a massive graph! Trimming to 100 most abundant clusters and re-plotting...")
+                    aln_file = f"{self.amp_folder}/{ref}_TEMP.fasta"
                     with open(f"{aln_file}", "w") as f:
-                        seen = set()
-                        for idx, seq in enumerate(self.results[ref]):
-                            if not seq[1] in seen:
-                                f.write(
-                                    f">{ref}_{self.a['ExpName']}_{idx} {seq[0]}\n{seq[1]}\n")
-                            seen.add(seq[1])
-                            if len(seen) > 100:
-                                break
-                loginfo(
-                    f"Generating alignment and graph for ref {ref}. This might take a few moments.")
-                shell(
-                    f"mafft --auto --thread {self.a['NThreads']} {aln_file} > {self.amp_folder}/{ref}.aln")
-                out = shell(
-                    f"pymsaviz -i {self.amp_folder}/{ref}.aln -o {self.amp_folder}/{ref}.png --color_scheme Identity --show_consensus --show_grid", is_test=True)
-                if "ValueError" in out:
-                    logerr(
-                        f"I couldn't produce an alignment plot for ref {ref}, this usually happens if you have so many unique amplicons to align that the plot would be insanely huge.")
-                elif "Traceback" in out:  # RM < TODO Proper error handler - look for output
-                    stoperr(
-                        f"Plotting alignment raised an error. This usually happens if pyMSAviz isn't installed, see error output for more details: {out}")
-                if "TEMP" in aln_file:
-                    shell(f"rm {aln_file}")
-
-    def clean(self):
-        '''Delete TSV file when done'''
-        shell(f"rm {self.bam_fname.replace('.bam','.tsv')}")
+                        [f.write(f">{ref}_{self.a['ExpName']}_rep{idx} {i[1]} count={i[2]} n_unique={i[3]}\n{i[0]}\n")
+                         for idx, i in enumerate(reps[0:100])]
+                aln_jobs.append([ref, aln_file])
+
+        if len(aln_jobs) == 0:
+            return
+        '''Bounded pool: each job is small (<= 100 seqs), so split threads across jobs rather than give every mafft call all of them'''
+        n_workers = max(1, min(int(self.a['NThreads']), len(aln_jobs)))
+        job_threads = max(1, int(self.a['NThreads']) // n_workers)
+        loginfo(
+            f"Generating alignments and graphs for {len(aln_jobs)} refs ({n_workers} at a time). This might take a few moments.")
+        errors = []
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(self.align_and_plot, ref, aln_file, job_threads): ref
+                       for ref, aln_file in aln_jobs}
+            for future in as_completed(futures):
+                '''Don't abort other refs; report all failures once every job is done'''
+                try:
+                    err = future.result()
+                except Exception as ex:
+                    err = f"{ex}"
+                if err:
+                    errors.append(f"{futures[future]}: {err}")
+        if errors:
+            stoperr(
+                f"Plotting alignment raised an error for {len(errors)}/{len(aln_jobs)} refs. This usually happens if pyMSAviz isn't installed, see error output for more details: {errors}")
+
+    def cluster_reads(self, ref, uniq_reads) -> list:
+        '''Greedy identity clustering of unique reads into abundance-weighted representatives (most abundant first), saving memberships'''
+        reps, memberships = cluster_by_identity([[i[0], i[1], i[3]] for i in uniq_reads],
+                                                self.cluster_identity, self.cluster_kmer)
+        loginfo(
+            f"Clustered {len(uniq_reads)} unique reads for ref {ref} into {len(reps)} clusters at {self.cluster_identity * 100}% identity")
+        pd.DataFrame(memberships, columns=["read_id", "count", "representative_id", "identity"]).to_csv(
+            f"{self.amp_folder}/{ref}_clusters.csv", index=False)
+        return sorted(reps, key=lambda x: -x[2])
+
+    def align_and_plot(self, ref, aln_file, n_threads) -> str:
+        '''MSA and alignment plot for one ref; returns error output if plotting failed'''
+        shell(
+            f"mafft --auto --thread {n_threads} {aln_file} > {self.amp_folder}/{ref}.aln")
+        out = shell(
+            f"pymsaviz -i {self.amp_folder}/{ref}.aln -o {self.amp_folder}/{ref}.png --color_scheme Identity --show_consensus --show_grid", is_test=True)
+        if "TEMP" in aln_file:
+            shell(f"rm {aln_file}")
+        if "ValueError" in out:
+            logerr(
+                f"I couldn't produce an alignment plot for ref {ref}, this usually happens if you have so many unique amplicons to align that the plot would be insanely huge.")
+        elif "Traceback" in out:  # RM < TODO Proper error handler - look for output
+            logerr(f"Plotting alignment raised an error for ref {ref}")
+            return out
+        return ""
 
     def main(self):
         loginfo("Running amplicon analysis")
-        seqs, read_stats = self.get_tsvs()
-        self.crunch(seqs)
+        batches = self.get_tsvs()
+        read_stats = self.crunch(batches)
         self.stats(read_stats)
         self.save()
-        self.clean()
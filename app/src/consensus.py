@@ -1,22 +1,27 @@
 import os
-import io
+import re
+import heapq
 import numpy as np
 import pandas as pd
 import pickle as p
+import subprocess as sp
 from Bio import AlignIO
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import plotly.express as px
-import re
 
 from app.utils.timer import timing
 from app.utils.shell_cmds import shell, make_dir, loginfo, stoperr, logerr
-from app.utils.utility_fns import read_fa, save_fa
-from app.utils.fnames import get_consensus_fnames
+from app.utils.utility_fns import read_fa, save_fa, normalise_ref_name
+from app.utils.fnames import get_consensus_fnames, get_cache_dir
+from app.utils.file_cache import FileCache, content_hash
 from app.utils.system_messages import end_sec_print
 from app.utils.basic_cli_calls import (
-    samtools_index, bwa_index, find_and_delete, rm, samtools_read_num)
+    samtools_index, find_and_delete, rm)
 from app.utils.error_handlers import error_handler_cli
+from app.utils.mapper_profiles import index_cmd, index_path, remap_cmd
 from app.utils.similarity_graph import call_graph
+from app.utils.pileup import TargetPileup, save_pileups
 
 import warnings
 # Pandas zero div errors
@@ -36,6 +41,14 @@ class Consensus:
         self.refs = [[i[0][0:101], i[1]] for i in read_fa(self.a["RefStem"])]
         self.probe_names = pd.read_csv(
             f"{self.a['SaveDir']}/{self.a['ExpName']}/probe_aggregation.csv")
+        '''Index targets by normalised name once, so per-target lookups don't rescan the whole panel'''
+        self.ref_index = {}
+        for idx, ref in enumerate(self.refs):
+            self.ref_index.setdefault(normalise_ref_name(ref[0]), idx)
+        self.probetype_index = dict(zip(
+            self.probe_names["orig_target_id"].astype(str).map(normalise_ref_name), self.probe_names["probetype"]))
+        self.probes_by_probetype = {
+            probetype: df for probetype, df in self.probe_names.groupby("probetype")}
         self.fnames = get_consensus_fnames(self.a)
         try:
             self.grouped_reads = p.load(
@@ -44,66 +57,59 @@ class Consensus:
             stoperr(f"Failed to load groupedreads.p. To save space, this file is DELTED after running the consensus algorithm if debugmode = False. Please re-run the pipeline, selecting debug mode on if you wish to run the consensus algorithm several times.")
         self.grouped_reads_keep = {}
         self.subconsensuses = {}
+        self.projected_consensuses = {}
+        self.organism_filters = {}
         if start_with_bam:
             self.fnames['master_bam'] = f"{self.a['ExpDir']}/{[i for i in os.listdir(self.a['ExpDir']) if i[-4:] == '.bam'][0]}"
         self.eval_stats, self.naive_consensuses, self.coverage = {}, {}, None
+        self.coverage_index, self.pileups = {}, {}
+        self.plan = pd.DataFrame()
         self.lut = pd.read_csv(self.a["MappingRefTable"], index_col=False)
+        self.description_index = dict(
+            zip(self.lut["key"].astype(str), self.lut["description"]))
         make_dir(f"{self.a['folder_stem']}consensus_data/")
         make_dir(f"{self.a['folder_stem']}consensus_sequences/")
 
-    def filter_bam(self, tar_name) -> None:
-        '''Filter bam to specific target, call consensus sequence for sam alignment records, grouped by target'''
+    def display_name(self, tar_name) -> str:
+        '''Don't give the user the hashed header name, it will only upset them'''
         try:
-            '''Don't give the user the hashed header name, it will only upset them'''
-            sneaky_name = f'{tar_name.split("_")[0]}_{self.lut[self.lut["key"] == tar_name.split("_")[-1]]["description"].item()[0:100]}'
+            return f'{tar_name.split("_")[0]}_{self.description_index[tar_name.split("_")[-1]][0:100]}'
         except TypeError:
             '''If user has somehow broken fasta header'''
-            sneaky_name = f'{tar_name.split("_")[0]}'
-        except ValueError:
+            return f'{tar_name.split("_")[0]}'
+        except KeyError:
             stoperr(f"Castanet doesn't yet support calling a consensus sequence without you supplying a valid mapping reference table.")
+
+    def filter_bam(self, tar_name) -> None:
+        '''Filter bam to specific target, call consensus sequence for sam alignment records, grouped by target'''
+        sneaky_name = self.display_name(tar_name)
         loginfo(f"Calling subconsensus for target: {sneaky_name}")
         tar_name = tar_name.lower()
-        is_regex = False
-        if len(tar_name) > 99:
-            is_regex = True
-            prefix = re.escape(tar_name[:100])
-            match_name = f"(^|\s){prefix}(\d*)($|\s)"
-        else:
-            match_name = tar_name
-
-        coverage = self.coverage[self.coverage['#rname'].str.lower().str.contains(
-            match_name, regex=is_regex)]  # Needs to be a regex with separate match in case mismatch on length
+        tar_key = normalise_ref_name(tar_name)
 
-        if coverage.shape[0] > 1:
-            coverage = coverage[coverage["#rname"] == tar_name[0:100]]
-
-        try:
-            if tar_name != coverage.iloc[0][0]:
-                self.naive_consensuses[tar_name] = self.naive_consensuses[coverage.iloc[0][0]]
-                self.naive_consensuses.pop(coverage.iloc[0][0])
-        except:
+        if not tar_key in self.coverage_index.keys():
             stoperr(
                 f"Couldn't match consensus {sneaky_name} to read library. Have you tried to run this on a pre-existing data folder? Are you sure your mapping reference names are compatible with Castanet?")
+        coverage = self.coverage.loc[self.coverage_index[tar_key]]
 
-        if coverage.empty:
-            raise loginfo(
-                f"Could not generate a consensus for target: {sneaky_name}\nCheck your probe names correspond to the target names in your bam file. It's possible your probe naming scheme is incompatible with castanet.")
-
-        if float(coverage['meanmapq'].item()) < self.a["ConsensusMapQ"]:
+        if float(coverage['meanmapq']) < self.a["ConsensusMapQ"]:
             '''If coverage/depth don't surpass threshold, delete grouped reads dir'''
             loginfo(
-                f"Not adding subconsensus for {sneaky_name} to consensus for organism, Map Q was under minimmum threshold you set ({coverage['meanmapq'].item()})")
+                f"Not adding subconsensus for {sneaky_name} to consensus for organism, Map Q was under minimmum threshold you set ({coverage['meanmapq']})")
             return
         else:
             '''Else, call consensus on this target'''
             if not tar_name in self.subconsensuses.keys():
                 self.subconsensuses[tar_name] = []
-            if tar_name in self.naive_consensuses.keys():
-                self.subconsensuses[tar_name].append(
-                    f"{self.naive_consensuses[tar_name]}")
-            elif tar_name[:100] in self.naive_consensuses.keys():
-                self.subconsensuses[tar_name].append(
-                    f"{self.naive_consensuses[tar_name[:100]]}")
+            if tar_key in self.naive_consensuses.keys():
+                if self.a["ConsensusProjection"]:
+                    '''Keep reference coordinate version for projection; MSA path gets the usual (deletions dropped, uncovered ends trimmed)'''
+                    self.projected_consensuses[tar_key] = self.naive_consensuses[tar_key]
+                    self.subconsensuses[tar_name].append(
+                        self.naive_consensuses[tar_key].replace("*", "").strip("Nn"))
+                else:
+                    self.subconsensuses[tar_name].append(
+                        f"{self.naive_consensuses[tar_key]}")
 
     def collate_consensus_seqs(self, tar_name) -> None:
         '''Read and collate consensus seqs from per target to per organism'''
@@ -129,26 +135,20 @@ class Consensus:
 
     def aggregate_to_probename(self, ref) -> str:
         '''Group targets to organism via probe name (compiled in analysis.py)'''
-        match = self.probe_names.iloc[np.where(
-            np.isin(self.probe_names["orig_target_id"].str.lower(), ref[0:100].replace(">", "")))[0]]  # TODO < Curtailment
-
-        if match.empty:
+        ref_key = normalise_ref_name(ref)
+        if not ref_key in self.probetype_index.keys():
             print(
-                f"WARNING: Couldn't match reads to probe name: {self.probe_names['target_id']}")
+                f"WARNING: Couldn't match reads to probe name: {ref}")
             return f"Unmatched"
         else:
-            return f"{match['probetype'].item()}"
+            return f"{self.probetype_index[ref_key]}"
 
     def call_flat_consensus(self, org_name) -> None:
         '''Create consensus sequences'''
-        '''Make folder and dictionary key for supplementary stats'''
-        self.eval_stats[org_name] = {}
         organism_consensus_dir = f"{self.a['folder_stem']}consensus_data/{org_name}/"
-        if not os.path.isdir(organism_consensus_dir):
-            shell(f"mkdir {organism_consensus_dir}")
 
-        '''Filter bam to organism-specific targets, further filter by coverage %'''
-        coverage_filter, agg_names = self.filter_bam_to_organism(org_name)
+        '''Organism-specific targets, filtered by coverage % (bam already split by split_bam_by_organism)'''
+        coverage_filter, agg_names = self.organism_filters[org_name]
 
         if len(coverage_filter) == 0:
             loginfo(
@@ -172,18 +172,20 @@ class Consensus:
             all_subconsensuses = []
             genes = agg_names["AGGREGATE"].value_counts().index.tolist()
             genes.sort()
+            gene_by_target = dict(
+                zip(agg_names["target_id"], agg_names["AGGREGATE"]))
+            targets_by_gene = {}
+            for target in self.target_consensuses[org_name]:
+                if target["tar_name"] in gene_by_target.keys():
+                    targets_by_gene.setdefault(
+                        gene_by_target[target["tar_name"]], []).append(target)
             for gene in genes:
-                gene_targets = agg_names[agg_names["AGGREGATE"]
-                                         == gene]["target_id"].tolist()
-                for target in self.target_consensuses[org_name]:
-                    if target["tar_name"] in gene_targets:
-                        ref_names = list(set([i["tar_name"].replace(">", "").lower(
-                        ) for i in self.target_consensuses[org_name] if i["tar_name"] in target["tar_name"]]))
-                        tmp = target
-                        tmp["refseq"] = [ref for ref in self.refs if ref[0].replace(
-                            ">", "").split(" ")[0].lower() in ref_names][0][1]
-                        all_subconsensuses.append(
-                            [f">{target['tar_name']}", target["consensus_seq"]])
+                for target in targets_by_gene.get(gene, []):
+                    tmp = target
+                    tmp["refseq"] = self.refs[self.ref_index[normalise_ref_name(
+                        target["tar_name"])]][1]
+                    all_subconsensuses.append(
+                        [f">{target['tar_name']}", target["consensus_seq"]])
 
                 # 1. Get each refseqs
                 agg_refseq += tmp['refseq']
@@ -220,7 +222,10 @@ class Consensus:
                 f">{org_name}_consensus\n{flat_consensus}")
 
         '''Remap to re-made flat consensus, to make `re-mapped consensus`'''
-        self.remap_flat_consensus(org_name)
+        if self.a["ConsensusMaxDepth"] > 0:
+            self.remap_flat_consensus(org_name, self.cap_depth(org_name))
+        else:
+            self.remap_flat_consensus(org_name)
 
         '''Dump any additional stats to pickle'''
         self.dump_stats(org_name)
@@ -231,10 +236,10 @@ class Consensus:
 
     def build_msa_requisites(self, org_name) -> None:
         '''Create fasta files containing target reference seqs and consensus seqs, for downstream MSA'''
-        ref_seq_names = list(set([i["tar_name"].replace(">", "").lower()[:100]
-                                  for i in self.target_consensuses[org_name]]))
-        ref_seqs = [ref for ref in self.refs if ref[0].replace(
-            ">", "").split(" ")[0].lower() in ref_seq_names]
+        ref_seq_names = set([normalise_ref_name(i["tar_name"])
+                             for i in self.target_consensuses[org_name]])
+        ref_seqs = [self.refs[idx] for idx in sorted(
+            [self.ref_index[name] for name in ref_seq_names if name in self.ref_index.keys()])]
 
         assert len(
             ref_seqs) > 0, f"Couldn't match ref sequences to target name for {org_name}"
@@ -257,20 +262,18 @@ class Consensus:
 
         if len(ref_aln) > 1:
             '''Align flat consensus references'''
-            out = shell(
-                f"mafft --thread {self.a['NThreads']} --auto {self.fnames['flat_cons_refs']} > {ref_aln_fname}", is_test=True)
-
-            error_handler_cli(out, ref_aln_fname, "mafft")
+            self.align_flat_cons_refs(ref_aln, ref_aln_fname)
         else:
             '''If only 1 reference seq, the alignment wouldn't have worked - defer to temp refs file in these cases'''
             ref_aln_fname = self.fnames['flat_cons_refs']
 
         ref_aln_with_reads_fname = f"{self.a['folder_stem']}consensus_data/{org_name}/{org_name}_consensus_alignment.aln"
-        out = shell(f"mafft --thread {self.a['NThreads']} --auto --addfragments {self.fnames['flat_cons_seqs']} {ref_aln_fname}"
-                    f"> {ref_aln_with_reads_fname}", is_test=True)
+        if not (self.a["ConsensusProjection"] and self.project_consensuses(org_name, ref_aln_fname, ref_aln_with_reads_fname)):
+            out = shell(f"mafft --thread {self.a['NThreads']} --auto --addfragments {self.fnames['flat_cons_seqs']} {ref_aln_fname}"
+                        f"> {ref_aln_with_reads_fname}", is_test=True)
 
-        error_handler_cli(out, ref_aln_with_reads_fname,
-                          "mafft", test_f_size=True)
+            error_handler_cli(out, ref_aln_with_reads_fname,
+                              "mafft", test_f_size=True)
 
         try:
             if self.a["DebugMode"]:
@@ -283,6 +286,73 @@ class Consensus:
         '''Return flat consensus'''
         return self.dumb_consensus(f"{self.a['folder_stem']}consensus_data/{org_name}/", org_name)
 
+    def align_flat_cons_refs(self, refs, ref_aln_fname) -> None:
+        '''MSA of flat consensus references. The same reference set recurs across samples in a batch, so alignments are
+        cached keyed on the sorted hashes of the reference sequences plus mafft options, and reused where possible.'''
+        mafft_opts = "--auto"
+        '''Canonical (hash) order, so cached rows line up with these references whatever order they arrived in'''
+        refs = sorted(refs, key=lambda x: content_hash(x[1].lower()))
+        key = content_hash(*[content_hash(i[1].lower())
+                           for i in refs], mafft_opts)
+        cache = FileCache(get_cache_dir(self.a, "ref_alignments"),
+                          self.a["ConsensusRefAlnCacheMB"])
+        cached_aln = cache.get(key)
+        if cached_aln:
+            loginfo(f"Reusing cached reference alignment ({key[0:12]})")
+            '''Headers are panel specific (hashed keys), so swap in this panel's names'''
+            with open(ref_aln_fname, "w") as f:
+                [f.write(f"{ref[0]}\n{aln[1]}\n")
+                 for ref, aln in zip(refs, read_fa(cached_aln))]
+            return
+
+        with open(self.fnames['flat_cons_refs'], "w") as f:
+            [f.write(f"{i[0]}\n{i[1]}\n") for i in refs]
+        out = shell(
+            f"mafft --thread {self.a['NThreads']} {mafft_opts} {self.fnames['flat_cons_refs']} > {ref_aln_fname}", is_test=True)
+        error_handler_cli(out, ref_aln_fname, "mafft")
+        cache.put(key, ref_aln_fname)
+
+    def project_consensuses(self, org_name, ref_aln_fname, out_fname) -> bool:
+        '''Place target consensuses on the reference alignment via their own mapping coordinates, in place of mafft --addfragments.
+        Returns False (caller falls back to MSA) if references diverge beyond threshold, or a target can't be placed.'''
+        def divergence(a, b):
+            '''Proportion of columns at which two aligned seqs differ, ignoring columns gapped in both'''
+            a, b = np.array(list(a.upper())), np.array(list(b.upper()))
+            cols = (a != "-") | (b != "-")
+            return float((a[cols] != b[cols]).mean()) if cols.any() else 0.0
+
+        ref_aln = read_fa(ref_aln_fname)
+        ref_divergence = max([divergence(ref_aln[0][1], i[1])
+                              for i in ref_aln])
+        if ref_divergence > self.a["ConsensusProjectionMaxDivergence"]:
+            loginfo(
+                f"References for {org_name} are too divergent to project consensuses ({round(ref_divergence, 3)}), making MSA instead")
+            return False
+
+        '''Alignment column of each (ungapped) reference position'''
+        ref_cols = {normalise_ref_name(name): np.flatnonzero(np.array(list(seq)) != "-")
+                    for name, seq in ref_aln}
+        n_cols = len(ref_aln[0][1])
+        projected = []
+        for target in self.target_consensuses[org_name]:
+            tar_key = normalise_ref_name(target["tar_name"])
+            cons = self.projected_consensuses.get(tar_key)
+            if cons is None or not tar_key in ref_cols.keys() or len(cons) != len(ref_cols[tar_key]):
+                loginfo(
+                    f"Couldn't project consensus for {self.display_name(target['tar_name'])} onto reference alignment, making MSA instead")
+                return False
+            row = np.full(n_cols, "-")
+            '''Deletions and uncovered positions are gaps, as they would be after MSA'''
+            row[ref_cols[tar_key]] = list(
+                cons.upper().replace("*", "-").replace("N", "-"))
+            projected.append([f">{target['tar_name']}_CONS", "".join(row)])
+
+        loginfo(
+            f"Projected {len(projected)} target consensuses onto reference alignment for {org_name}")
+        with open(out_fname, "w") as f:
+            [f.write(f"{i[0]}\n{i[1]}\n") for i in ref_aln + projected]
+        return True
+
     def dumb_consensus_AGGREGATE(self, alnfpath, org_name) -> list:
         '''Produce an un-referenced/`flat` consensus sequence for file of target and target ref seqs'''
         # TODO < Disgusting, harmonise with regular dumb_consensus.
@@ -330,10 +400,12 @@ class Consensus:
 
     def filter_bam_to_organism(self, org_name) -> list:
         '''Output coverage stats for target consensuses'''
-        probels = self.probe_names[self.probe_names['probetype']
-                                   == org_name]['orig_target_id'].str.lower().tolist()
-        coverage_df = self.coverage[
-            self.coverage["#rname"].isin(probels) | self.coverage["#rname"].str.startswith(tuple(probels), na=False)]
+        org_probes = self.probes_by_probetype.get(
+            org_name, self.probe_names.iloc[0:0])
+        probels = org_probes['orig_target_id'].astype(
+            str).map(normalise_ref_name).tolist()
+        coverage_df = self.coverage.loc[[self.coverage_index[i]
+                                         for i in probels if i in self.coverage_index.keys()]]
         assert not coverage_df.empty, f"Call to samtools coverage returned empty output. Check that your bam file is indexed and that the path to it is correct."
 
         '''Get coverage for each consensus, filter collated bam by consensus coverage and map q'''
@@ -346,25 +418,83 @@ class Consensus:
         if len(coverage_filter) == 0:
             return [], pd.DataFrame()
         else:
-            '''Filter master bam for targets with sufficient coverage'''
-            probels = [f'{i}' for i in coverage_filter]
-            # Split into 2 due to backslash in f string
-            probels = [i.replace("|", "\|") for i in probels]
-            cmd = f"samtools view -@ {self.a['NThreads']} -b {self.fnames['master_bam']} {' '.join(probels)} > {self.a['folder_stem']}consensus_data/{org_name}/collated_reads.bam"
-            shell(cmd)
-            # TODO test output
-
-            '''Estimate number of mapped reads in the final alignment (get just primary mapped reads, div 2 to average F & R strands)'''
-            self.eval_stats[org_name]["filtered_collated_read_num"] = round(samtools_read_num(
-                f"{self.a['folder_stem']}consensus_data/{org_name}/collated_reads.bam", f'-F 0x904 -q {self.a["ConsensusMapQ"]}') / 2)
-
             ##### TEST -- bact aggregates ####
-            agg_names = self.probe_names[self.probe_names["target_id"].isin(
+            agg_names = org_probes[org_probes["target_id"].isin(
                 coverage_filter)]
             ########
 
             return coverage_filter, agg_names
 
+    def split_bam_by_organism(self, org_names) -> None:
+        '''Route each alignment in the master bam to the collated bam of its organism/aggregate in a single streaming pass.
+        Primary mapped reads passing MapQ are counted on the way through, in place of a samtools view -c per organism.'''
+        contig_to_org = {}
+        for org_name in org_names:
+            '''Make folder and dictionary key for supplementary stats'''
+            self.eval_stats[org_name] = {}
+            make_dir(f"{self.a['folder_stem']}consensus_data/{org_name}/")
+            '''Filter to organism-specific targets, further filter by coverage %'''
+            self.organism_filters[org_name] = self.filter_bam_to_organism(
+                org_name)
+            for contig in self.organism_filters[org_name][0]:
+                contig_to_org[contig.lower().encode()] = org_name
+
+        if len(contig_to_org) == 0:
+            return
+
+        loginfo(
+            f"Splitting master bam into collated reads for {len(set(contig_to_org.values()))} organisms")
+        '''Tool messages go to a log file rather than a pipe, so a chatty tool can't block the split'''
+        log_fname = f"{self.a['folder_stem']}split_bam.log"
+        with open(log_fname, "w") as log_h:
+            writers = {org_name: sp.Popen(f"samtools view -b -o {self.a['folder_stem']}consensus_data/{org_name}/collated_reads.bam -",
+                                          shell=True, stdin=sp.PIPE, stderr=log_h) for org_name in set(contig_to_org.values())}
+            read_nums = dict.fromkeys(writers.keys(), 0)
+            min_mapq = int(self.a["ConsensusMapQ"])
+            reader = sp.Popen(f"samtools view -h -@ {self.a['NThreads']} {self.fnames['master_bam']}",
+                              shell=True, stdout=sp.PIPE, stderr=log_h)
+            writer_died = False
+            try:
+                for line in reader.stdout:
+                    if line.startswith(b"@"):
+                        '''Every split bam gets the full header'''
+                        for w in writers.values():
+                            w.stdin.write(line)
+                        continue
+                    _, flag, rname, _, mapq, _ = line.split(b"\t", 5)
+                    org_name = contig_to_org.get(rname.lower())
+                    if org_name is None:
+                        continue
+                    writers[org_name].stdin.write(line)
+                    '''Equivalent of samtools view -c -F 0x904 -q ConsensusMapQ'''
+                    if not int(flag) & 0x904 and int(mapq) >= min_mapq:
+                        read_nums[org_name] += 1
+            except BrokenPipeError:
+                '''A writer died: stop reading, it's reported by its exit code below'''
+                writer_died = True
+                reader.kill()
+            reader.stdout.close()
+            reader.wait()
+            for w in writers.values():
+                try:
+                    w.stdin.close()
+                except BrokenPipeError:
+                    pass
+                w.wait()
+        failed = [f"master bam reader ({reader.returncode})"] if reader.returncode != 0 and not writer_died else []
+        failed += [f"{org_name} writer ({w.returncode})" for org_name, w in writers.items() if w.returncode != 0]
+        if failed:
+            with open(log_fname) as f:
+                err = f.read()
+            stoperr(
+                f"Castanet failed to split the master bam file into per-organism bam files: {', '.join(failed)} exited with errors. Samtools error: {err}")
+        os.remove(log_fname)
+
+        for org_name, read_num in read_nums.items():
+            '''Estimate number of mapped reads in the final alignment (get just primary mapped reads, div 2 to average F & R strands)'''
+            self.eval_stats[org_name]["filtered_collated_read_num"] = round(
+                read_num / 2)
+
     def filter_tar_consensuses(self, org_name, filter) -> None:
         '''Purge target consensus from master list if coverage was lower than threshold (aln is consequently remade)'''
         to_del = [i for i in range(len(self.target_consensuses[org_name]))
@@ -378,30 +508,59 @@ class Consensus:
                 del self.target_consensuses[org_name][i]
             return
 
+    def cap_depth(self, org_name) -> str:
+        '''Downsample organism's collated reads to ConsensusMaxDepth before remapping. Deterministic and position-stratified: primary
+        reads are taken in coordinate order while depth at their start is under the cap, and mates are kept together. Returns capped bam.'''
+        org_dir = f"{self.a['folder_stem']}consensus_data/{org_name}/"
+        max_depth = int(self.a["ConsensusMaxDepth"])
+        keep, ends, contig = set(), [], None
+        n_reads, n_kept = 0, 0
+        reader = sp.Popen(["samtools", "view", f"{org_dir}collated_reads.bam"],
+                          stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+        for line in reader.stdout:
+            qname, flag, rname, pos, _, cigar, _ = line.split("\t", 6)
+            if int(flag) & 0x904:
+                continue
+            n_reads += 1
+            pos = int(pos)
+            if rname != contig:
+                contig, ends = rname, []
+            '''End positions of kept reads still overlapping this one; heap size is depth at this read's start'''
+            while ends and ends[0] <= pos:
+                heapq.heappop(ends)
+            if qname in keep or len(ends) < max_depth:
+                keep.add(qname)
+                n_kept += 1
+                heapq.heappush(ends, pos + sum([int(n) for n, op in re.findall(
+                    r"([0-9]+)([MIDNSHP=X])", cigar) if op in "MDN=X"]))
+        _, err = reader.communicate()
+        if reader.returncode != 0:
+            stoperr(
+                f"Castanet failed to read collated reads for {org_name} while capping depth. Samtools error: {err}")
+
+        with open(f"{org_dir}depth_capped_reads.txt", "w") as f:
+            [f.write(f"{i}\n") for i in keep]
+        shell(
+            f"samtools view -@ {self.a['NThreads']} -b -N {org_dir}depth_capped_reads.txt -o {org_dir}depth_capped_reads.bam {org_dir}collated_reads.bam")
+        rm(f"{org_dir}depth_capped_reads.txt")
+        loginfo(
+            f"Capped depth for {org_name} at {max_depth}: remapping {n_kept}/{n_reads} primary mapped reads")
+        self.eval_stats[org_name]["precap_read_num"] = n_reads
+        self.eval_stats[org_name]["postcap_read_num"] = n_kept
+        return f"{org_dir}depth_capped_reads.bam"
+
     # @timing
-    def remap_flat_consensus(self, org_name) -> None:
-        '''Remap reads to flattened consensus, save, call stats, remove raw fastas'''
+    def remap_flat_consensus(self, org_name, reads_bam=None) -> None:
+        '''Remap reads (master bam, unless a depth capped bam is given) to flattened consensus, save, call stats, remove raw fastas'''
+        reads_bam = reads_bam if reads_bam else self.fnames['master_bam']
         flat_cons_fname = f"{self.a['folder_stem']}consensus_data/{org_name}/{org_name}_remapped_consensus_sequence.fasta"
 
-        if self.a["Mapper"] == "bwa":
-            bwa_index(
-                f"{self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta")
-            shell(f"samtools fastq -@ {self.a['NThreads']} {self.fnames['master_bam']} |"
-                  f"bwa-mem2 mem -t {self.a['NThreads']} {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta - | "
-                  f"viral_consensus -i - -r {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta -o {flat_cons_fname} --min_depth {self.a['ConsensusMinD']} --out_pos_counts {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_consensus_pos_counts.csv")
-
-        # TODO < tidy common elements # TODO < delete btl intermediate files
-        elif self.a["Mapper"] == "bowtie2":
-            shell(
-                f"bowtie2-build {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta {self.a['folder_stem']}consensus_data/{org_name}/reference_indices", is_test=True)
-            shell(f"samtools fastq -@ {self.a['NThreads']} {self.fnames['master_bam']} |"
-                  f"bowtie2 -x {self.a['folder_stem']}consensus_data/{org_name}/reference_indices -U - -p {self.a['NThreads']} --local -I 50 --maxins 2000 --no-unal |"
-                  f"viral_consensus -i - -r {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta -o {flat_cons_fname} --min_depth {self.a['ConsensusMinD']} --out_pos_counts {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_consensus_pos_counts.csv")
-
-        elif self.a["Mapper"] == "minimap2":
-            shell(f"samtools fastq -@ {self.a['NThreads']} {self.fnames['master_bam']} |"
-                  f"minimap2 -ax map-ont {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta - |"
-                  f"viral_consensus -i - -r {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta -o {flat_cons_fname} --min_depth {self.a['ConsensusMinD']} --out_pos_counts {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_consensus_pos_counts.csv")
+        flat_ref = f"{self.a['folder_stem']}consensus_data/{org_name}/{org_name}_flat_consensus_sequence.fasta"
+        '''Reads are streamed to the mapper as one file, so are mapped as single ended; indices are deleted with the raw fastas'''
+        shell(index_cmd(self.a["Mapper"], flat_ref,
+              self.a["NThreads"], True), is_test=True)
+        shell(f"{remap_cmd(self.a['Mapper'], index_path(self.a['Mapper'], flat_ref), reads_bam, self.a['NThreads'])} | "
+              f"viral_consensus -i - -r {flat_ref} -o {flat_cons_fname} --min_depth {self.a['ConsensusMinD']} --out_pos_counts {self.a['folder_stem']}consensus_data/{org_name}/{org_name}_consensus_pos_counts.csv")
 
         try:
             error_handler_cli("", flat_cons_fname,
@@ -514,45 +673,120 @@ class Consensus:
             logerr(
                 f"Couldn't generate summary for {org}. This usually happens if a consensus sequence failed to generate. Error details: {ex}")
 
+    def target_read_counts(self) -> dict:
+        '''Mapped reads (every mate, incl. secondary/supplementary) per target, from the master bam index'''
+        out = shell(f"samtools idxstats {self.fnames['master_bam']}",
+                    "Target read counts, consensus plan", ret_output=True).decode("utf-8")
+        counts = {}
+        for line in out.strip().split("\n"):
+            fields = line.split("\t")
+            if len(fields) == 4 and fields[0] != "*":
+                counts[normalise_ref_name(fields[0])] = int(fields[2])
+        return counts
+
+    def gate_pileups(self, hit_targets, read_counts) -> list:
+        '''
+        First half of the consensus plan, before any pileup: drop hit targets that can't pass whatever their pileup shows.
+        Depth at any position of a target can't exceed the reads mapped to it, so an organism none of whose targets has
+        ConsensusMinD mapped reads can't pass; nor can targets with no probetype. Returns targets to pileup.
+        '''
+        plan = pd.DataFrame([[target, self.probetype_index.get(normalise_ref_name(target), "Unmatched"),
+                              read_counts.get(normalise_ref_name(target), 0)] for target in hit_targets],
+                            columns=["target", "probetype", "mapped_reads"])
+        org_max_reads = plan.groupby("probetype")["mapped_reads"].transform("max")
+        plan["reason"] = np.select([plan["probetype"] == "Unmatched",
+                                    org_max_reads < self.a["ConsensusMinD"]],
+                                   ["No probetype", f"Organism has no target with >= {self.a['ConsensusMinD']} mapped reads"], default="")
+        self.plan = plan[plan["reason"] != ""]
+        return plan[plan["reason"] == ""]["target"].tolist()
+
+    def plan_consensus(self) -> list:
+        '''
+        Second half of the consensus plan, from the pileups of targets passing gate_pileups. These give the same depths
+        (per mate), coverage and MapQ that consensus calling and the coverage/MapQ filters later use, so nothing that
+        could pass is pruned. An organism with no position at ConsensusMinD, or a target covering less than
+        ConsensusCoverage or under ConsensusMapQ, can't pass. Returns targets to keep; all CLI work on the rest is skipped.
+        '''
+        plan = []
+        for target, pileup in self.pileups.items():
+            depth, coverage = pileup.depth(), pileup.coverage()
+            plan.append([target, self.probetype_index.get(normalise_ref_name(target), "Unmatched"),
+                         coverage[3], coverage[5], int(depth.max()) if depth.size else 0, coverage[8]])
+        plan = pd.DataFrame(
+            plan, columns=["target", "probetype", "mapped_reads", "coverage", "max_depth", "meanmapq"])
+        org_max_depth = plan.groupby("probetype")["max_depth"].transform("max")
+        plan["reason"] = np.select([org_max_depth < self.a["ConsensusMinD"],
+                                    plan["coverage"] < self.a["ConsensusCoverage"],
+                                    plan["meanmapq"] < self.a["ConsensusMapQ"]],
+                                   [f"Organism has no positions at depth >= {self.a['ConsensusMinD']}",
+                                    "Target coverage < ConsensusCoverage", "Target MapQ < ConsensusMapQ"], default="")
+        plan = pd.concat([plan, self.plan]) if not self.plan.empty else plan
+        plan["planned"] = plan["reason"] == ""
+        '''Saved outside consensus_data, where every file is taken to be an organism's output'''
+        plan_fname = f"{self.a['folder_stem']}consensus_plan.csv"
+        plan.to_csv(plan_fname, index=False)
+        planned = plan[plan["planned"]]
+        loginfo(f"Consensus plan: {planned['target'].nunique()}/{plan.shape[0]} targets with hits in "
+                f"{planned['probetype'].nunique()}/{plan['probetype'].nunique()} organisms can pass consensus thresholds. "
+                f"Saved to {plan_fname}")
+        if planned.shape[0] > 0:
+            loginfo(
+                f"Organisms in plan: {', '.join(sorted(planned['probetype'].astype(str).unique()))}")
+        return planned["target"].tolist()
+
+    def call_target_pileups(self, targets) -> list:
+        '''Pileup each of a shard of targets, via region queries on indexed master bam'''
+        return [TargetPileup(target).run(self.fnames['master_bam']) for target in targets]
+
     def main(self) -> None:
         '''Entrypoint. Index main bam, filter it, make target consensuses, then create flattened consensus'''
         end_sec_print(
             "INFO: Calling consensus sequences\nThis may take a little while...")
         samtools_index(f"{self.fnames['master_bam']}")
-        group_consensus_fname = f"{self.a['folder_stem']}consensus_temp.fasta"
 
-        '''Get consensus and coverage for each target, memoize'''
+        '''Pileup each target with hits (most panel targets have none) that could pass, once, sharded across threads; naive consensus and coverage both come from it'''
         out = shell("samtools", is_test=True)
-        shell(  # Quicker all in one than out of loop
-            f"""samtools consensus -@ {self.a['NThreads']} --min-depth {self.a["ConsensusMinD"]} -f fasta '{self.fnames['master_bam']}' -o '{group_consensus_fname}'""")
-        error_handler_cli(out, group_consensus_fname,
-                          "samtools", test_out_f=True, test_f_size=True)
-
-        naive_consensuses_raw = {i[0].replace(
-            ">", ""): i[1] for i in read_fa(f"{group_consensus_fname}")}
-        for key in naive_consensuses_raw.keys():
-            if len(key) > 100:
-                self.naive_consensuses[key[0:100].lower(
-                )] = naive_consensuses_raw[key]
-            else:
-                self.naive_consensuses[key.lower(
-                )] = naive_consensuses_raw[key]
-
-        end_sec_print("INFO: Calling coverage across all targets")
-        self.coverage = pd.read_csv(io.StringIO(shell(f"samtools coverage '{self.fnames['master_bam']}'", "Coverage, consensus filter bam", ret_output=True).decode(
-        )), sep="\t")
-        assert not self.coverage.empty, "Call to samtools coverage returned empty output. Check that your bam file is indexed and that the path to it is correct."
+        error_handler_cli(out, "", "samtools", test_out_f=False)
+        hit_targets = self.gate_pileups(
+            list(self.grouped_reads.keys()), self.target_read_counts())
+        n_shards = max(1, min(int(self.a['NThreads']), len(hit_targets)))
+        end_sec_print(
+            f"INFO: Calling pileup across {len(hit_targets)} targets with hits")
+        with ThreadPoolExecutor(max_workers=n_shards) as executor:
+            self.pileups = {pileup.target: pileup for shard in executor.map(
+                self.call_target_pileups, [hit_targets[i::n_shards] for i in range(n_shards)]) for pileup in shard}
+        if self.a["DebugMode"]:
+            save_pileups(
+                f"{self.a['folder_stem']}consensus_data/target_pileups.npz", self.pileups)
+
+        hit_targets = self.plan_consensus()
+        if len(hit_targets) == 0:
+            end_sec_print(
+                "INFO: No organisms can pass consensus thresholds, so no consensus sequences will be called")
+            self.tidy()
+            return
+        for target in hit_targets:
+            self.naive_consensuses[normalise_ref_name(target)] = self.pileups[target].consensus(
+                self.a["ConsensusMinD"], reference_coords=self.a["ConsensusProjection"])
+
+        self.coverage = pd.DataFrame([i.coverage() for i in self.pileups.values()], columns=[
+            "#rname", "startpos", "endpos", "numreads", "covbases", "coverage", "meandepth", "meanbaseq", "meanmapq"])
+        assert not self.coverage.empty, "Pileup returned empty output. Check that your bam file is indexed and that the path to it is correct."
         self.coverage["#rname"] = self.coverage["#rname"].str.lower()
+        self.coverage_index = {normalise_ref_name(
+            rname): idx for idx, rname in self.coverage["#rname"].items()}
 
-        for key in self.grouped_reads.keys():
+        for key in hit_targets:
             self.filter_bam(key)
         self.grouped_reads.clear()
 
         '''Consensus for each thing target group'''
         [self.collate_consensus_seqs(tar_name)
             for tar_name in self.subconsensuses.keys() if "BACT" not in tar_name]
-        [self.call_flat_consensus(
-            i) for i in self.target_consensuses.keys() if i != "Unmatched"]
+        org_names = [
+            i for i in self.target_consensuses.keys() if i != "Unmatched"]
+        self.split_bam_by_organism(org_names)
+        [self.call_flat_consensus(i) for i in org_names]
 
         '''Tidy up'''
         self.clean_incomplete_consensus()
@@ -560,10 +794,9 @@ class Consensus:
 
         '''Call CSV summary generator'''
         [self.generate_summary(i) for i in os.listdir(
-            f"{self.a['folder_stem']}/consensus_data/") if not "GROUND_TRUTH" in i and not ".fna" in i and not i.startswith(".")]
+            f"{self.a['folder_stem']}/consensus_data/") if not "GROUND_TRUTH" in i and not ".fna" in i and not ".npz" in i and not i.startswith(".")]
 
         '''Final tidy up'''
-        shell(f"rm {group_consensus_fname}")
         find_and_delete(
             f"{self.a['folder_stem']}consensus_data/", "*.p")
         find_and_delete(
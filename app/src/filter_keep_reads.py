@@ -1,12 +1,19 @@
 from __future__ import division
 import os
+import io
+import numpy as np
 import subprocess as sp
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from app.utils.shell_cmds import loginfo, read_line, shell, logerr
+from app.utils.shell_cmds import loginfo, read_line, shell, logerr, stoperr
 from app.utils.error_handlers import error_handler_filter_keep_reads
 from app.utils.system_messages import end_sec_print
-from app.utils.utility_fns import enumerate_read_files
+from app.utils.utility_fns import enumerate_read_files, stream_fastq_blocks, compress_cmd
+from app.utils.fnames import get_intermediate_fnames
+from app.utils.read_counts import record_read_count
+from app.utils.read_name_set import ReadNameSet
+from app.utils.kmer_screen import KmerPanel
+from app.src.preprocess import stream_kraken, finish_kraken_stream
 '''
 DEPRECATED AS OF V9.0
 '''
@@ -29,7 +36,10 @@ class FilterKeepReads:
             self.a["o"], self.a["ExcludeIds"], self.a["RetainIds"] = error_handler_filter_keep_reads(
                 self.a)
         '''Empty vars'''
-        self.reads_to_exclude, self.reads_to_keep = deque(), deque()
+        self.reads_to_exclude, self.reads_to_keep = ReadNameSet(), ReadNameSet()
+        self.block_size = 4194304  # Bytes of FASTQ parsed at a time
+        self.num_reads = []
+        self.prescreen, self.panel, self.num_prescreened = None, None, 0
 
     def cmd_string(self, inpath):
         '''Expand file shell command depending on input file extension'''
@@ -37,44 +47,106 @@ class FilterKeepReads:
 
     def filter_Reads(self, inpath, out_h):
         '''
-        Collect the four lines belonging to the next read and filter on readname.
+        Filter reads on readname, a block of records at a time: names are looked up in the keep/exclude sets
+        together and all kept records in a block are written in one go.
         ASSUMES NO BLANK LINES IN INPUT.
         '''
         handle = sp.Popen([i for i in self.cmd_string(inpath)] + [inpath],
-                          bufsize=8192, stdout=sp.PIPE).stdout
-        line = read_line(handle)
-        num_reads = 0
-        while line:
-            readheader, seq, qh, qual = line, read_line(
-                handle), read_line(handle), read_line(handle)
-            line = read_line(handle)
-            readname = readheader[1:].split('/')[0].split()[0]
-            to_keep = True if not self.reads_to_keep or (
-                self.reads_to_keep and (readname in self.reads_to_keep)) else False
-            to_exclude = True if (self.reads_to_exclude and (
-                readname in self.reads_to_exclude)) else False
-            if to_keep and not to_exclude:
-                out_h.write(''.join((readheader, seq, qh, qual)))
-                num_reads += 1
-        return num_reads
+                          bufsize=self.block_size, stdout=sp.PIPE).stdout
+        num_in, num_reads = 0, 0
+        for lines in stream_fastq_blocks(handle, self.block_size):
+            readnames = [i[1:].split('/')[0].split()[0]
+                         for i in lines[0::4]]
+            keep = np.ones(len(readnames), dtype=bool)
+            if self.prescreen is not None:
+                keep &= self.prescreen[num_in:num_in + len(readnames)]
+            if self.panel is not None:
+                screened = self.panel.screen(lines[1::4], self.a["PrescreenMinKmers"])
+                self.num_prescreened += int(screened.sum())
+                keep &= screened
+            if self.reads_to_keep:
+                keep &= self.reads_to_keep.contains(readnames)
+            if self.reads_to_exclude:
+                keep &= ~self.reads_to_exclude.contains(readnames)
+            out_h.write("".join(
+                [f"{lines[i]}\n{lines[i+1]}\n{lines[i+2]}\n{lines[i+3]}\n" for i in np.flatnonzero(keep) * 4]))
+            num_in += len(readnames)
+            num_reads += int(keep.sum())
+        return num_in, num_reads
+
+    def screen_file(self, inpath, panel) -> np.ndarray:
+        '''Mask of records in inpath passing k-mer prescreen'''
+        handle = sp.Popen([i for i in self.cmd_string(inpath)] + [inpath],
+                          bufsize=self.block_size, stdout=sp.PIPE).stdout
+        masks = [panel.screen(lines[1::4], self.a["PrescreenMinKmers"])
+                 for lines in stream_fastq_blocks(handle, self.block_size)]
+        return np.concatenate(masks) if masks else np.empty(0, dtype=bool)
+
+    def prescreen_reads(self) -> None:
+        '''
+        Screen paired reads for k-mers shared with RefStem, before filtering. Reads of a pair are kept if either mate passes.
+        Costs an extra decompress and parse of every read file: files are screened first (concurrently) so pairs stay in sync
+        when R1 and R2 are then filtered concurrently. Single ended reads are instead screened as they are filtered.
+        '''
+        end_sec_print("INFO: Prescreening reads for k-mers shared with mapping reference.")
+        panel = KmerPanel(self.a).load()
+        with ThreadPoolExecutor(max_workers=len(self.a["input_file"])) as pool:
+            masks = list(pool.map(lambda x: self.screen_file(
+                x, panel), self.a["input_file"]))
+        if len(set([len(i) for i in masks])) > 1:
+            stoperr(
+                f"Your read files have different numbers of reads ({', '.join([str(len(i)) for i in masks])}), so can't be prescreened as pairs. Check they are properly paired.")
+        self.prescreen = np.logical_or.reduce(masks)
+        n_pass = int(self.prescreen.sum())
+        loginfo(
+            f"K-mer prescreen passed {n_pass}/{len(self.prescreen)} reads ({100 * n_pass / max(1, len(self.prescreen)):.2f}%).")
+        record_read_count(self.a, "post_prescreen", n_pass)
+
+    def filter_file(self, inpath, outpath) -> tuple:
+        if not outpath.endswith(".gz"):
+            with open(outpath, 'w', buffering=self.block_size) as out_h:
+                return self.filter_Reads(inpath, out_h)
+        '''Compressed intermediates are written through an external (multithreaded) compressor'''
+        with open(outpath, 'wb') as raw_h:
+            proc = sp.Popen(compress_cmd(int(self.a["NThreads"]) // 2), shell=True,
+                            stdin=sp.PIPE, stdout=raw_h)
+            broken_pipe = False
+            try:
+                with io.TextIOWrapper(proc.stdin, encoding="utf-8") as out_h:
+                    counts = self.filter_Reads(inpath, out_h)
+            except BrokenPipeError:
+                '''Compressor exited before taking all reads: the file is incomplete whatever its exit code'''
+                broken_pipe = True
+            proc.wait()
+        if broken_pipe or proc.returncode != 0:
+            stoperr(
+                f"Compressing filtered reads to {outpath} failed (compressor {'exited early' if broken_pipe else 'failed'}, exit code {proc.returncode}), so the file is incomplete. Check there's enough disk space, or set IntermediateCompression to false.")
+        return counts
 
     def main(self):
         '''Entrypoint'''
         if self.a["DoKrakenPrefilter"]:
             '''Read in Kraken file, populate exclude/retain ID loc sets'''
             end_sec_print("INFO: Filtering reads using Kraken2 annotations.")
-            handle = sp.Popen([i for i in self.cmd_string(
-                self.a['kraken'])] + [self.a['kraken']], bufsize=8192, stdout=sp.PIPE).stdout
+            if self.a["KrakenStream"]:
+                kraken_proc = stream_kraken(
+                    {**self.a, "SeqNames": self.a["input_file"]})
+                handle = kraken_proc.stdout
+            else:
+                handle = sp.Popen([i for i in self.cmd_string(
+                    self.a['kraken'])] + [self.a['kraken']], bufsize=8192, stdout=sp.PIPE).stdout
             line = read_line(handle)
             while line:
                 readname, taxid = line.split()[1:3]
                 if taxid in self.a["ExcludeIds"]:
-                    self.reads_to_exclude.append(readname)
+                    self.reads_to_exclude.add(readname)
                 elif taxid in self.a["RetainIds"]:
-                    self.reads_to_keep.append(readname)
+                    self.reads_to_keep.add(readname)
                 line = read_line(handle)
-            self.reads_to_exclude, self.reads_to_keep = frozenset(
-                self.reads_to_exclude), frozenset(self.reads_to_keep)
+            if self.a["KrakenStream"]:
+                finish_kraken_stream(self.a, kraken_proc)
+            self.reads_to_exclude.freeze()
+            self.reads_to_keep.freeze()
             loginfo(
                 f'Excluding {len(self.reads_to_exclude)} reads ({len(self.a["ExcludeIds"])} taxa specified).')
             loginfo(
@@ -83,16 +155,34 @@ class FilterKeepReads:
         else:
             '''If not doing kraken filter, just copy and decompress the files'''
             logerr("Skipping Kraken Prefilter as you specified to.")
-            self.reads_to_exclude = self.reads_to_keep = ()
-            self.a['o'] = [
-                f'{self.a["SaveDir"]}/{self.a["ExpName"]}/{self.a["ExpName"]}_{i}_filt.fastq' for i in range(1, 3)]
+            self.a['o'] = get_intermediate_fnames(self.a)["filt_files"]
 
-        '''Iterate over input file, filter reads by excl and retain rules, save output'''
-        for (inpath, outpath) in zip(self.a["input_file"], self.a["o"]):
-            with open(outpath, 'w', buffering=8192) as out_h:
-                num_reads = self.filter_Reads(inpath, out_h)
+        if self.a["KmerPrescreen"]:
+            if len(self.a["input_file"]) == 1:
+                '''No mate to keep in sync, so screen in the filter pass rather than an extra one'''
+                end_sec_print("INFO: Prescreening reads for k-mers shared with mapping reference, while filtering.")
+                self.panel = KmerPanel(self.a).load()
+            else:
+                self.prescreen_reads()
+
+        '''Iterate over input files, filter reads by excl and retain rules, save output. R1 and R2 run concurrently.'''
+        file_pairs = list(zip(self.a["input_file"], self.a["o"]))
+        with ThreadPoolExecutor(max_workers=len(file_pairs)) as pool:
+            all_counts = list(pool.map(
+                lambda x: self.filter_file(*x), file_pairs))
+        self.num_reads = [i[1] for i in all_counts]
+        for (_, outpath), num_reads in zip(file_pairs, self.num_reads):
             loginfo(f'Wrote {num_reads} reads to {outpath}.')
+        if len(set(all_counts)) > 1:
+            stoperr(
+                f"Your read files gave different numbers of reads (in, kept: {', '.join([str(i) for i in all_counts])}) after filtering, so are no longer paired. Check they are properly paired, with matching read names.")
+        if self.panel is not None:
+            loginfo(
+                f"K-mer prescreen passed {self.num_prescreened}/{all_counts[0][0]} reads ({100 * self.num_prescreened / max(1, all_counts[0][0]):.2f}%).")
+            record_read_count(self.a, "post_prescreen", self.num_prescreened)
+        record_read_count(self.a, "raw", all_counts[0][0])
+        record_read_count(self.a, "post_filter", all_counts[0][1])
 
-        shell(
-            f"rm {self.a['SaveDir']}/{self.a['ExpName']}/{self.a['ExpName']}.kraken")
+        if os.path.exists(self.a["kraken"]):
+            shell(f"rm {self.a['kraken']}")
         end_sec_print("INFO: Filter reads complete.")
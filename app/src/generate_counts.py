@@ -1,7 +1,8 @@
 import os
 import pickle
 import subprocess as sp
-from app.utils.utility_fns import enumerate_bam_files
+from app.utils.utility_fns import enumerate_bam_files, compress_cmd
+from app.utils.fnames import get_intermediate_fnames
 from app.utils.shell_cmds import shell
 from app.utils.system_messages import end_sec_print
 from app.utils.shell_cmds import stoperr
@@ -34,14 +35,15 @@ def run_counts(p, start_with_bam=False):
         if os.stat(in_file).st_size < 2:
             stoperr(
                 f"Your input BAM file ({in_file}) is empty. Please review how it was generated, i.e. was your mapping successful.")
-    bamview_fname = f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_bamview.txt"
+    bamview_fname = get_intermediate_fnames(p)["bamview"]
+    compress = f" | {compress_cmd(p['NThreads'])}" if bamview_fname.endswith(".gz") else ""
 
     '''Split samtools pipe to python with persistent file for ease of debugging'''
     end_sec_print("Info: Generating read counts ")
     '''Included blank call to SAMtools for error handler, as successful call prints nowt'''
     out = shell(f"samtools", is_test=True)
     shell(
-        f"""samtools view -@ {p['NThreads']} -F2048 -F4 {in_file} > {bamview_fname}""")
+        f"""samtools view -@ {p['NThreads']} -F2048 -F4 {in_file}{compress} > {bamview_fname}""")
     error_handler_cli(out, bamview_fname, "samtools")
 
     # TODO < quicker to print data file through lambda than read pickle?
@@ -1,18 +1,41 @@
 import os
-import pickle
 import shutil
 from app.utils.utility_fns import enumerate_read_files
+from app.utils.fnames import get_intermediate_fnames
 from app.utils.shell_cmds import shell
 from app.utils.system_messages import end_sec_print
-from app.utils.shell_cmds import stoperr, logerr
+from app.utils.shell_cmds import stoperr
 from app.utils.error_handlers import error_handler_cli
+from app.utils.index_cache import IndexCache
+from app.utils.mapper_profiles import MAPPER_PROFILES, map_to_bam_cmd
+
+
+def index_mapping_ref(p) -> str:
+    '''Get mapper index for RefStem from the shared index cache (building it only if no earlier sample or run has), and set
+    p["MapIndex"] to it. Batches fetch it once up front and pass the index and its build log on to every sample'''
+    if "RefIndexLog" in p.keys() and "MapIndex" in p.keys():
+        return p["RefIndexLog"]
+    if not p["Mapper"] in MAPPER_PROFILES.keys():
+        stoperr(
+            f"User option for mapping software ('Mapper' parameter) is not 'bwa', 'bowtie2' or 'minimap2' (you specified '{p['Mapper']}'), so I can't proceed")
+    p["MapIndex"], log = IndexCache(p).get()
+    return log
+
+
+def mapper_cmd(p, in_files) -> str:
+    '''Shell command mapping reads in in_files (1 or 2 files) with p["Mapper"], to sorted bam of mapped reads'''
+    if not p["Mapper"] in MAPPER_PROFILES.keys():
+        stoperr(
+            f"User option for mapping software ('Mapper' parameter) is not 'bwa', 'bowtie2' or 'minimap2' (you specified '{p['Mapper']}'), so I can't proceed")
+    stem = f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}"
+    return map_to_bam_cmd(p["Mapper"], p["MapIndex"], in_files, f"{stem}.bam", p["NThreads"], f"{stem}_sort")
 
 
 def run_map(p, is_test=False):
     '''Use BWA and Samtools to map reads from each sample to targets'''
     '''Default in_files are created by the trimming step'''
-    in_files = [f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_clean.fastq",
-                f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_2_clean.fastq"]
+    clean_files = get_intermediate_fnames(p)["clean_files"]
+    in_files = clean_files
     CLEAN_UP = True
 
     # TODO < So much redundancy here. Can be refactored into single loop
@@ -29,64 +52,44 @@ def run_map(p, is_test=False):
             stoperr(
                 f"Castanet found an input file: {fn}, but it's empty. Please check your input file have been processed appropriately for input to BWA-mem2.")
 
-    '''Calculate total n trimmed reads, for later calculation of read proportions (in analysis.py)'''
-    try:
-        out = int(
-            shell(f"echo $(cat {in_files[0]}|wc -l)/4|bc", ret_output=True).decode("utf-8"))
-        pickle.dump(
-            out, open(f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_rawreadnum.p", "wb"))
-    except Exception as e:
-        logerr(f"Failed to calculate n trimmed reads from fastq files. Defaulting to calculating from total reads in bam.")
-
     if p["Mapper"] == "bwa":
         end_sec_print(
             f"INFO: Beginning initial mapping using BWA\nThis may take a while for large files")
-        out = shell(f"bwa-mem2 index {p['RefStem']}", is_test=True)
+        out = index_mapping_ref(p)
         if p["SingleEndedReads"]:
-            shell(
-                f"bwa-mem2 mem -t {p['NThreads']} {p['RefStem']} {in_files[0]} | samtools view -F4 -Sb - | samtools sort - 1> {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam")
+            shell(mapper_cmd(p, in_files[0:1]))
             shell(  # This is done out of sync with CLEAN_UP as we can't assume user has not transferred single file to exp directory
-                f"rm {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_clean.fastq")
+                f"rm {clean_files[0]}")
 
         else:
-            shell(
-                f"bwa-mem2 mem -t {p['NThreads']} {p['RefStem']} {in_files[0]} {in_files[1]} | samtools view -F4 -Sb - | samtools sort - 1> {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam")
+            shell(mapper_cmd(p, in_files[0:2]))
 
         error_handler_cli(
             out, f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam", "bwa-mem2", test_f_size=True)
 
-        if CLEAN_UP:
-            '''Remove mapping ref indices'''
-            shell(f"rm {p['SaveDir']}/{p['ExpName']}/ref.fa.*")
-
     elif p["Mapper"] == "bowtie2":
         end_sec_print(
             f"INFO: Beginning initial mapping using Bowtie2\nThis may take a while for large files")
-        ref_dir = f"{p['SaveDir']}/reference_indices"
-        if not os.path.exists(ref_dir):
-            os.mkdir(ref_dir)
-        out = shell(
-            f"bowtie2-build --large-index {p['RefStem']} {p['SaveDir']}/reference_indices", is_test=True)
+        out = index_mapping_ref(p)
         if p["SingleEndedReads"]:
-            shell(f"bowtie2 -x {p['SaveDir']}/reference_indices -U {in_files[0]} -p {p['NThreads']} --local -I 50 --maxins 2000 --no-unal | samtools view -@ {p['NThreads']} -h -Sb -F4 -F2048 - | samtools sort -@ {p['NThreads']} - 1> {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam")
+            shell(mapper_cmd(p, in_files[0:1]))
         else:
-            shell(f"bowtie2 -x {p['SaveDir']}/reference_indices -1 {in_files[0]} -2 {in_files[1]} -p {p['NThreads']} --local -I 50 --maxins 2000 --no-unal | samtools view -@ {p['NThreads']} -h -Sb -F4 -F2048 - | samtools sort -@ {p['NThreads']} - 1> {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam")
+            shell(mapper_cmd(p, in_files[0:2]))
         error_handler_cli(
             out, f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam", "bowtie2", test_f_size=True)
 
     elif p["Mapper"] == "minimap2":
         end_sec_print(
             f"INFO: Beginning initial mapping using Minimap2\nThis may take a while for large files")
+        index_mapping_ref(p)
 
         if p["SingleEndedReads"]:
-            out = shell(
-                f"minimap2 -ax map-ont {p['RefStem']} {in_files[0]} | samtools view -F4 -Sb - | samtools sort - 1> {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam",  is_test=True)
+            out = shell(mapper_cmd(p, in_files[0:1]), is_test=True)
             shell(  # This is done out of sync with CLEAN_UP as we can't assume user has not transferred single file to exp directory
-                f"rm {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_clean.fastq")
+                f"rm {clean_files[0]}")
 
         else:
-            out = shell(
-                f"minimap2 -a {p['RefStem']} {in_files[0]} {in_files[1]} | samtools view -F4 -Sb - | samtools sort - 1> {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam",  is_test=True)
+            out = shell(mapper_cmd(p, in_files[0:2]), is_test=True)
 
         error_handler_cli(
             out, f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}.bam", "minimap2", test_f_size=True)
@@ -96,7 +99,6 @@ def run_map(p, is_test=False):
             f"User option for mapping software ('Mapper' parameter) is not 'bwa' or 'bowtie2' (you specified '{p['Mapper']}'), so I can't proceed")
 
     if CLEAN_UP:
-        shell(
-            f"rm {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_[12]_clean.fastq")
+        shell(f"rm {' '.join(clean_files)}")
 
     end_sec_print(f"INFO: Mapping complete")
@@ -6,7 +6,8 @@ import os
 from app.utils.error_handlers import error_handler_parse_bam_positions, error_handler_cli
 from app.utils.argparsers import parse_args_bam_parse
 from app.utils.shell_cmds import make_dir, shell, loginfo
-from app.utils.utility_fns import get_gene_orgid, trim_long_fpaths
+from app.utils.utility_fns import get_gene_orgid, trim_long_fpaths, open_intermediate
+from app.utils.fnames import get_intermediate_fnames
 from app.utils.basic_cli_calls import samtools_index
 
 
@@ -26,7 +27,7 @@ class Parse_bam_positions:
         self.reads_by_hit = {}
         self.fnames = {
             "bam": f"{self.p['SaveDir']}/{self.p['ExpName']}/{self.p['ExpName']}.bam",
-            "bamview": f"{self.p['SaveDir']}/{self.p['ExpName']}/{self.p['ExpName']}_bamview.txt",
+            "bamview": get_intermediate_fnames(self.p)["bamview"],
             "delreads": f"{self.p['SaveDir']}/{self.p['ExpName']}/{self.p['ExpName']}_reads_to_del.txt",
             "bamfilt": f"{self.p['SaveDir']}/{self.p['ExpName']}/{self.p['ExpName']}_filtered.bam",
             # TODO < Harmonise with fnames.py
@@ -86,7 +87,7 @@ class Parse_bam_positions:
         '''Read serialised BAM file into memory, create unique indexes for vectorised matching with filter list'''
         headers = []
         dat = {}
-        for l in open(self.fnames['bamview']):
+        for l in open_intermediate(self.fnames['bamview']):
             if l.startswith('@'):  # ignore headers
                 continue
 
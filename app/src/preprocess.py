@@ -4,6 +4,7 @@ from app.utils.utility_fns import enumerate_read_files
 from app.utils.system_messages import end_sec_print
 from app.utils.shell_cmds import stoperr
 import os
+import subprocess as sp
 
 
 def rm_existing_kraken(out_fnames):
@@ -13,20 +14,43 @@ def rm_existing_kraken(out_fnames):
             os.remove(ofn)
 
 
+def kraken_cmd(p, output=None):
+    '''Kraken2 call; per-read output goes to stdout if output is None (NB "--output -" would suppress it)'''
+    paired = ""
+    if len(p["SeqNames"]) == 2:
+        paired = "--paired"
+    return f'kraken2 --db {p["KrakenDbDir"]} {paired} --threads {p["NThreads"]} {f"--output {output} " if output else ""}--report {p["SaveDir"]}/{p["ExpName"]}/kraken_report.tsv {" ".join(p["SeqNames"])}'
+
+
 def run_kraken(p):
     '''Call Kraken2 to label unwanted reads'''
+    if "KrakenStream" in p.keys() and p["KrakenStream"]:
+        end_sec_print(
+            f"INFO: Kraken2 annotations will be streamed straight into read filtering (KrakenStream)")
+        return
     out_fnames = [f'{p["SaveDir"]}/{p["ExpName"]}/{p["ExpName"]}.kraken',
                   f'{p["SaveDir"]}/{p["ExpName"]}/kraken_report.tsv']
     rm_existing_kraken(out_fnames)
-    paired = ""
-    if len(p["SeqNames"]) == 2:
-        paired = "--paired"
 
     try:
-        out = shell(
-            f'kraken2 --db {p["KrakenDbDir"]} {paired} --threads {p["NThreads"]} --output {out_fnames[0]} --report {out_fnames[1]} {" ".join(p["SeqNames"])}', is_test=True)
+        out = shell(kraken_cmd(p, out_fnames[0]), is_test=True)
     except IndexError:
         stoperr(f"Two input read files were not found in the direcotry you specified")
     '''Test for success'''
     error_handler_cli(out, out_fnames[1], "kraken")
     end_sec_print(f"Kraken2 annotations complete")
+
+
+def stream_kraken(p) -> sp.Popen:
+    '''Call Kraken2 with per-read output on stdout, for consumption as it's produced; only the report is written to disk'''
+    rm_existing_kraken([f'{p["SaveDir"]}/{p["ExpName"]}/kraken_report.tsv'])
+    return sp.Popen(kraken_cmd(p), shell=True, bufsize=8192, stdout=sp.PIPE, stderr=sp.PIPE)
+
+
+def finish_kraken_stream(p, proc) -> None:
+    '''Wait for streamed Kraken2 call to exit; test for success'''
+    err = proc.stderr.read().decode("utf-8")
+    proc.wait()
+    error_handler_cli(
+        err, f'{p["SaveDir"]}/{p["ExpName"]}/kraken_report.tsv', "kraken")
+    end_sec_print(f"Kraken2 annotations complete")
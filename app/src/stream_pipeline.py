@@ -0,0 +1,125 @@
+import os
+import time
+import signal
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from app.src.filter_keep_reads import FilterKeepReads
+from app.src.trim_adapters import trim_cmd, record_trimmed_read_num
+from app.src.map_reads_to_ref import mapper_cmd, index_mapping_ref
+from app.utils.shell_cmds import stoperr, logerr
+from app.utils.system_messages import end_sec_print
+from app.utils.error_handlers import error_handler_cli
+from app.utils.fnames import get_intermediate_fnames
+from app.utils.mapper_profiles import MAPPER_PROFILES
+
+'''
+Streaming alternative to running filter_keep_reads -> trim_adapters -> map_reads_to_ref one after another.
+Stages are connected by named pipes (FIFOs) in the experiment folder, so reads flow through once, without
+intermediate FASTQs being written to disk. Tool logs are written to disk and checked when the stream ends.
+'''
+
+
+def make_fifos(fnames) -> None:
+    for fname in fnames:
+        if os.path.exists(fname):
+            os.remove(fname)
+        os.mkfifo(fname)
+
+
+def unblock_fifos(fnames) -> None:
+    '''Open each FIFO's read end without blocking, so a writer left waiting on a dead reader can proceed (and fail)'''
+    for fname in fnames:
+        try:
+            os.close(os.open(fname, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+
+def kill_stage(proc) -> None:
+    '''Kill a stage's whole process group (shell and the tools it piped together)'''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_stream_pipeline(p) -> None:
+    '''Filter, trim and map one sample as a single stream: FilterKeepReads -> FIFO -> Trimmomatic -> FIFO -> mapper'''
+    end_sec_print(
+        "INFO: Filtering, trimming and mapping reads as one stream (StreamPipeline)")
+    stem = f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}"
+    n_files = 1 if p["SingleEndedReads"] else 2
+    '''Streams are never compressed, so the pipes take the uncompressed intermediate names'''
+    p_fifo = {**p, "IntermediateCompression": False}
+    filt_fifos = get_intermediate_fnames(p_fifo)["filt_files"][0:n_files]
+    clean_fifos = get_intermediate_fnames(p_fifo)["clean_files"][0:n_files]
+    logs = {"trim": f"{stem}_trim.log", "map": f"{stem}_map.log"}
+
+    index_out = index_mapping_ref(p)
+    fifos = filt_fifos + clean_fifos if p["DoTrimming"] else filt_fifos
+    make_fifos(fifos)
+
+    '''Start consumers first: they block on opening their input FIFOs until the upstream stage opens them for writing'''
+    procs, log_handles = {}, {k: open(v, "w") for k, v in logs.items()}
+    map_in = clean_fifos if p["DoTrimming"] else filt_fifos
+    procs["map"] = sp.Popen(mapper_cmd(p, map_in), shell=True, start_new_session=True,
+                            stderr=log_handles["map"])
+    if p["DoTrimming"]:
+        procs["trim"] = sp.Popen(trim_cmd(p, filt_fifos, clean_fifos, ["/dev/null", "/dev/null"]), shell=True,
+                                 start_new_session=True, stderr=log_handles["trim"])
+
+    clf = FilterKeepReads(p_fifo)
+    early_exit = []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(clf.main)
+        while not future.done():
+            '''Downstream tools can't finish before filtering has: if one exits, stop the stream rather than hang on its FIFOs'''
+            exited = [k for k, proc in procs.items() if proc.poll() is not None]
+            if exited:
+                '''Grace period, as a small sample's reads may all be mapped while the filter is still wrapping up'''
+                wait([future], timeout=10)
+                if not future.done():
+                    early_exit = exited
+                    for proc in procs.values():
+                        kill_stage(proc)
+                    unblock_fifos(fifos)
+                break
+            time.sleep(1)
+        filter_err = future.exception()
+    if filter_err:
+        for proc in procs.values():
+            kill_stage(proc)
+        unblock_fifos(fifos)
+    for proc in procs.values():
+        proc.wait()
+    for handle in log_handles.values():
+        handle.close()
+    for fname in fifos:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+    '''Tool logs are only removed once every check has passed, so they're left to inspect if the stream fails'''
+    log_out = {k: open(v).read() for k, v in logs.items()}
+    if early_exit:
+        stoperr(f"Castanet's streamed pipeline failed: the {early_exit[0]} stage exited before all reads had been streamed to it. "
+                f"Tool's error message: {log_out[early_exit[0]]}")
+    elif filter_err:
+        logerr(f"Read filtering failed part way through the stream. Trimming and mapping logs kept: {', '.join(logs.values())}")
+        raise filter_err
+    for stage, proc in procs.items():
+        if proc.returncode != 0:
+            stoperr(
+                f"Castanet's streamed pipeline failed at the {stage} stage. Tool's error message: {log_out[stage]}")
+
+    '''Same checks as the unstreamed stages'''
+    if p["DoTrimming"]:
+        error_handler_cli(log_out["trim"], None,
+                          "trimmomatic_se" if n_files == 1 else "trimmomatic_pe", test_out_f=False)
+    error_handler_cli(log_out["map"] if p["Mapper"] == "minimap2" else index_out, f"{stem}.bam",
+                      MAPPER_PROFILES[p["Mapper"]]["tool"], test_f_size=True)
+
+    record_trimmed_read_num(p, log_out["trim"])
+    for fname in logs.values():
+        os.remove(fname)
+    end_sec_print(f"INFO: Mapping complete")
@@ -1,18 +1,47 @@
 import os
+import re
 from app.utils.shell_cmds import shell, logerr
-from app.utils.utility_fns import enumerate_read_files
+from app.utils.utility_fns import enumerate_read_files, compress_cmd
+from app.utils.fnames import get_intermediate_fnames
+from app.utils.read_counts import get_read_counts, record_read_count
 from app.utils.system_messages import end_sec_print
 from app.utils.error_handlers import error_handler_cli
 
 
+def trim_cmd(p, in_files, clean_files, trim_files) -> str:
+    '''Trimmomatic command, SE if one input file else PE'''
+    if len(in_files) == 1:
+        return f"trimmomatic SE -phred64 -threads {p['NThreads']} {in_files[0]} {clean_files[0]} ILLUMINACLIP:{p['AdaptP']}:2:10:7:1:true MINLEN:{p['TrimMinLen']}"
+    return f"trimmomatic PE -threads {p['NThreads']} {in_files[0]} {in_files[1]} {clean_files[0]} {trim_files[0]} {clean_files[1]} {trim_files[1]} ILLUMINACLIP:{p['AdaptP']}:2:10:7:1:true MINLEN:{p['TrimMinLen']}"
+
+
+def trimmed_read_num(trim_log):
+    '''Number of reads (R1) surviving trimming, from Trimmomatic's summary line'''
+    hit = re.search(r"(?:Both Surviving|Input Reads: \d+ Surviving): (\d+)", trim_log)
+    return int(hit.group(1)) if hit else None
+
+
+def record_trimmed_read_num(p, trim_log) -> None:
+    '''Record post-trim read count from Trimmomatic's log, or carry the post-filter count through if not trimming'''
+    if p["DoTrimming"]:
+        read_num = trimmed_read_num(trim_log)
+    else:
+        read_num = get_read_counts(p).get("post_filter")
+    if read_num is None:
+        logerr(f"Couldn't find n trimmed reads. Defaulting to calculating from total reads in bam.")
+        return
+    record_read_count(p, "post_trim", read_num)
+
+
 def run_trim(p):
     '''Call Trimmomatic trim CLI tool; check it worked; remove interim files'''
     p["ExpDir"] = f"{p['ExpDir']}/"
     CLEAN_UP = True
+    fnames = get_intermediate_fnames(p)
     files = {
-        "in_files": [f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_filt.fastq", f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_2_filt.fastq"],
-        "clean_files": [f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_clean.fastq", f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_2_clean.fastq"],
-        "trim_files": [f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_trimmings.fq", f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_2_trimmings.fq"]
+        "in_files": fnames["filt_files"],
+        "clean_files": fnames["clean_files"],
+        "trim_files": fnames["trim_files"]
     }
     if not os.path.exists(files['in_files'][0]):
         '''If default filtered files not available, find input fastqs'''
@@ -22,14 +51,15 @@ def run_trim(p):
     if p["DoTrimming"]:
         end_sec_print("INFO: Read Trimming beginning.")
         if p["SingleEndedReads"]:
-            out = shell(f"trimmomatic SE -phred64 -threads {p['NThreads']} {files['in_files'][0]} {files['clean_files'][0]} ILLUMINACLIP:{p['AdaptP']}:2:10:7:1:true MINLEN:{p['TrimMinLen']}", is_test=True)
+            out = shell(trim_cmd(p, files['in_files'][0:1], files['clean_files'], files['trim_files']), is_test=True)
             mode = "trimmomatic_se"
         else:
-            out = shell(f"trimmomatic PE -threads {p['NThreads']} {files['in_files'][0]} {files['in_files'][1]} {files['clean_files'][0]} {files['trim_files'][0]} {files['clean_files'][1]} {files['trim_files'][1]} ILLUMINACLIP:{p['AdaptP']}:2:10:7:1:true MINLEN:{p['TrimMinLen']}", is_test=True)
+            out = shell(trim_cmd(p, files['in_files'][0:2], files['clean_files'], files['trim_files']), is_test=True)
             mode = "trimmomatic_pe"
 
         error_handler_cli(out, files['clean_files']
                           [0], mode, test_f_size=True)
+        record_trimmed_read_num(p, out)
 
         if CLEAN_UP:
             for idx, fi in enumerate(files['in_files']):
@@ -38,7 +68,12 @@ def run_trim(p):
     else:
         '''If not trimming, just rename the filtered files to the trim output fnames'''
         logerr(f"Skipping trimming as you specified to")
-        ext = ".gz" if files['in_files'][0][-3:] == ".gz" else ""
         for idx, fi in enumerate(files['in_files']):
-            shell(f"cp {fi} {files['clean_files'][idx]}{ext}")
+            if files['clean_files'][idx].endswith(".gz") and not fi.endswith(".gz"):
+                shell(
+                    f"{compress_cmd(p['NThreads'])} {fi} > {files['clean_files'][idx]}")
+            else:
+                ext = ".gz" if fi.endswith(".gz") and not files['clean_files'][idx].endswith(".gz") else ""
+                shell(f"cp {fi} {files['clean_files'][idx]}{ext}")
+        record_trimmed_read_num(p, "")
     end_sec_print("INFO: Read Trimming complete.")
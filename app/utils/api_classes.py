@@ -18,6 +18,8 @@ class Data_Ubiquitous(BaseModel):
                               description="Path to mapping file, in fasta format.")
     MappingRefTable: str = Query("./my_mapping_ref_table.csv",
                                  description="Path to mapping ref table file, to be created with the convert_mapping_reference function (see documentation).")
+    IntermediateCompression: bool = Query(False,
+                                          description="If true, gzip intermediate files written between pipeline stages (filtered/trimmed reads, BAM views) with a fast multithreaded compressor (pigz, if installed), to save scratch disk space at some CPU cost.")
 
 
 class Data_DataFolder(BaseModel):
@@ -56,6 +58,15 @@ class Data_FilterFilters(BaseModel):
     DoKrakenPrefilter: bool = Query(True,
                                     description="If true, run an initial pre-filtering step to label reads with Kraken2 and exclude those belonging to taxonomies indicated in Exclude/Retain IDs/Names arguments. If false, these other fields are ignored.")
 
+    KrakenStream: bool = Query(False,
+                               description="If true, Kraken2's per-read output is streamed straight into read filtering rather than written to a (large) .kraken file first. The Kraken2 report is still saved. Only used if DoKrakenPrefilter = true.")
+
+    KmerPrescreen: bool = Query(False,
+                                description="If true, reads (or read pairs) sharing fewer than PrescreenMinKmers 21-mers with the mapping reference (RefStem) are dropped before trimming and mapping. Cheaply removes off-target reads from e.g. host-heavy samples. The reference k-mer index is built once per reference and cached in SaveDir. Applied with or without DoKrakenPrefilter. Single ended reads are screened as they are filtered; paired reads need one extra decompress and parse of every read file (screened first, so pairs stay in sync), which is only worth it when many reads are off-target.")
+
+    PrescreenMinKmers: int = Query(2,
+                                   description="Minimum number of 21-mers a read (or either read in a pair) must share with the mapping reference to pass the k-mer prescreen. Only used if KmerPrescreen = true.")
+
     LineageFile: Union[None, str] = Query('data/ncbi_lineages_2023-06-15.csv.gz',
                                           description="(OPTIONAL) Path to CSV file containing lineages of all NCBI taxa. Only used if DoKrakenPrefilter = true.")
 
@@ -79,6 +90,11 @@ class Data_TrimmomaticParams(BaseModel):
                             description="Values < than min trim length will be removed by Trimmomatic tool. Only used if DoTrimming = true")
 
 
+class Data_StreamPipeline(BaseModel):
+    StreamPipeline: bool = Query(False,
+                                 description="If true, stream reads from filtering through trimming to mapping via named pipes, rather than writing full FASTQ files between each stage. Ignored in DebugMode, which keeps intermediate files.")
+
+
 class Data_MappingParameters(BaseModel):
     Mapper: Literal["bwa", "bowtie2", "minimap2"] = Query("bwa",
                                                           description="Choose mapping software, options are 'bwa' for BWA-Mem2, 'bowtie2' or 'minimap2'. Default is 'bwa'.")
@@ -95,6 +111,14 @@ class Data_ConsensusParameters(BaseModel):
                                  description="Minimum quality value for a target consensus to be included in the remapped consensus (ignored if DoConsensus = false).")
     ConsensusTrimTerminals: bool = Query(True,
                                          description="Trim terminals of consensus sequence where both 3' and 5' end are ambiguous or gaps, AND constitute >5 percent of total genome length.")
+    ConsensusRefAlnCacheMB: int = Query(1024,
+                                        description="Size limit (MB) of the cache of reference alignments kept in SaveDir/castanet_cache and reused across samples and reruns. Set to 0 to disable caching (ignored if DoConsensus = false).")
+    ConsensusMaxDepth: int = Query(0,
+                                   description="Downsample each organism's reads to this depth before remapping to the flat consensus, to speed up very high depth (e.g. amplicon) samples. Set to 0 to disable (ignored if DoConsensus = false).")
+    ConsensusProjection: bool = Query(False,
+                                      description="If true, place target consensuses on the reference alignment using their mapping coordinates, instead of aligning them with MAFFT, when calling the flat consensus (ignored if DoConsensus = false).")
+    ConsensusProjectionMaxDivergence: float = Query(0.1,
+                                                    description="Maximum proportion of differing alignment columns between an organism's references for ConsensusProjection to be used; above this, the MAFFT alignment is used instead (ignored if ConsensusProjection = false).")
     # ConsensusCleanFiles: bool = Query(True, # RM < TODO deprecated with v9
     #                                   description="If True, consensus generator will delete BAM files for reads aggregated to each target organism. Disable to retain files for use in downstream analysis (ignored if DoConsensus = false).")
     GtFile: Optional[str] = Query('',
@@ -138,21 +162,28 @@ class Convert_mapping_ref_data(BaseModel):
 '''Endpoint objects'''
 
 
-class E2e_data(Data_AdaptP, Data_MappingParameters,
+class E2e_data(Data_AdaptP, Data_MappingParameters, Data_StreamPipeline,
                Data_PostFilt, Data_KrakenDir,
                Data_ConsensusParameters, Data_FilterFilters, Data_TrimmomaticParams, Data_GenerateCounts,
                Data_Ubiquitous, Data_ExpDir):
     pass
 
 
-class Amp_e2e_data(Data_AdaptP, Data_MappingParameters,
+class Amp_e2e_data(Data_AdaptP, Data_MappingParameters, Data_StreamPipeline,
                    Data_KrakenDir, Data_FilterFilters,
                    Data_TrimmomaticParams, Data_GenerateCounts,
                    Data_Ubiquitous, Data_ExpDir):
     pass
 
 
-class E2e_eval_data(Data_Ubiquitous, Data_AdaptP, Data_MappingParameters,
+class Amp_batch_data(Data_AdaptP, Data_MappingParameters, Data_StreamPipeline,
+                     Data_KrakenDir, Data_FilterFilters,
+                     Data_TrimmomaticParams, Data_GenerateCounts,
+                     Data_Ubiquitous, Data_DataFolder):
+    pass
+
+
+class E2e_eval_data(Data_Ubiquitous, Data_AdaptP, Data_MappingParameters, Data_StreamPipeline,
                     Data_PostFilt, Data_KrakenDir, Data_FilterFilters,
                     Data_ConsensusParameters, Data_TrimmomaticParams, Data_GenerateCounts, Data_ExpDir):
     pass
@@ -167,7 +198,7 @@ class Preprocess_data(Data_Ubiquitous, Data_KrakenDir, Data_TrimmomaticParams, D
     pass
 
 
-class Filter_keep_reads_data(Data_Ubiquitous, Data_FilterFilters, Data_TrimmomaticParams, Data_ExpDir):
+class Filter_keep_reads_data(Data_Ubiquitous, Data_KrakenDir, Data_FilterFilters, Data_TrimmomaticParams, Data_ExpDir):
     pass
 
 
@@ -195,7 +226,7 @@ class Amplicon_data(Data_Ubiquitous, Data_ExpDir):
     pass
 
 
-class Batch_eval_data(Data_AdaptP, Data_PostFilt, Data_KrakenDir, Data_MappingParameters,
+class Batch_eval_data(Data_AdaptP, Data_PostFilt, Data_KrakenDir, Data_MappingParameters, Data_StreamPipeline,
                       Data_ConsensusParameters, Data_GenerateCounts, Data_FilterFilters, Data_TrimmomaticParams,
                       Data_Ubiquitous, Data_DataFolder):
     pass
@@ -1,8 +1,8 @@
 import os
-import pickle
 import subprocess as sp
 
 from app.utils.shell_cmds import shell, loginfo
+from app.utils.read_counts import get_read_counts
 
 
 def samtools_index(fpath):
@@ -11,14 +11,12 @@ def samtools_index(fpath):
 
 def get_read_num(args, bam_fname):
     '''Get read num from pre-mapping stage if possible, else default to bam'''
-    pickles = [i for i in os.listdir(
-        f"{args['SaveDir']}/{args['ExpName']}/") if i[-12:] == "rawreadnum.p"]
-    if len(pickles) == 1:
-        loginfo(f"Retrieving raw read numbers from trimmed fastq")
-        read_num = pickle.load(
-            open(f"{args['SaveDir']}/{args['ExpName']}/{pickles[0]}", "rb"))
+    counts = get_read_counts(args)
+    if "post_trim" in counts.keys():
+        loginfo(f"Retrieving raw read numbers recorded by the trimming stage")
+        read_num = counts["post_trim"]
     else:
-        loginfo(f"Retrieving read numbers from bam (fastq was not found; this might be because of your choice of pipeline)")
+        loginfo(f"Retrieving read numbers from bam (no read count was recorded by the trimming stage; this might be because of your choice of pipeline)")
         read_num = samtools_read_num(bam_fname)
     return read_num
 
@@ -4,7 +4,6 @@ from app.utils.shell_cmds import shell
 def files_to_kill():
     return [
         "./SAVEDIR/EXPNAME/EXPNAME_PosCounts.csv",
-        "./SAVEDIR/EXPNAME/EXPNAME_rawreadnum.p",
         "./SAVEDIR/EXPNAME/EXPNAME.bam",
         "./SAVEDIR/EXPNAME/EXPNAME.bai",
         "./SAVEDIR/EXPNAME/probe_aggregation.csv",
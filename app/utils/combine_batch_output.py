@@ -39,6 +39,24 @@ def cov_csvs(fnames, out_fname):
     beeg_df.to_csv(out_fname.replace(".csv", "_coverage.csv"))
 
 
+def amplicon_stats_csvs(fnames, out_fname):
+    '''Combine per-sample amplicon read statistics ({sample: csv path}) into one per-target table'''
+    beeg_df = pd.DataFrame()
+    for sample, fname in fnames.items():
+        try:
+            df = pd.read_csv(fname, index_col=0)
+            df.index.name = "target"
+            df["sample"] = sample
+            beeg_df = pd.concat([beeg_df, df])
+        except Exception as e:
+            print(
+                f"Warning: Failed appending amplicon read statistics to batch csv: {fname}"
+                f"Reason: {e}")
+            continue
+    beeg_df.to_csv(out_fname)
+    return f"Combined amplicon read statistics from all samples in batch saved to {out_fname}"
+
+
 def combine_output_csvs(fnames, out_fname):
     depth_csvs(fnames, out_fname)
     cov_csvs(fnames, out_fname)
@@ -1,11 +1,11 @@
 import os
 import pandas as pd
-import subprocess as sp
 from collections import deque
 from termcolor import colored
-import platform
 
-from app.utils.shell_cmds import loginfo, stoperr, read_line
+from app.utils.shell_cmds import loginfo, stoperr
+from app.utils.lineage_index import LineageIndex
+from app.utils.fnames import get_intermediate_fnames
 
 
 def error_handler_filter_keep_reads(argies):
@@ -15,20 +15,17 @@ def error_handler_filter_keep_reads(argies):
     '''
     retain_list, exclude_list, argies["o"] = deque(), deque(), []
     '''Check in path, set up output path'''
-    cnt = 1
-    for inpath in argies["input_file"]:
+    for cnt, inpath in enumerate(argies["input_file"]):
         if not os.path.isfile(inpath):
             stoperr(f'Unable to open FastQ file {inpath}.')
         '''Append suffix "filt" to output file'''
-        argies["o"].append(  # RM < TODO TIDY FROM V1
-            f'{argies["SaveDir"]}/{argies["ExpName"]}/{argies["ExpName"]}_{cnt}_filt.fastq')
-        cnt += 1
+        argies["o"].append(get_intermediate_fnames(argies)["filt_files"][cnt])
     loginfo(f'Output files {argies["o"]}')
 
     '''Check input files'''
     if len(argies["input_file"]) != len(argies["o"]):
         stoperr('Could not create output paths for all given input files.')
-    if not os.path.isfile(argies["kraken"]):
+    if not argies["KrakenStream"] and not os.path.isfile(argies["kraken"]):
         stoperr(
             f'Unable to open Kraken file {argies["kraken"]} for input {argies["input_file"]}. Have you run the preprocess command before this one to create the kraken file?')
 
@@ -43,20 +40,9 @@ def error_handler_filter_keep_reads(argies):
                 argies["ExcludeNames"].split(','), exclude_list))
             if '' in taxa:
                 del taxa['']
-            if platform.system() == "Darwin":
-                cmd = 'gzcat' if argies["LineageFile"].endswith(
-                    '.gz') else 'cat'
-            else:
-                cmd = 'zcat' if argies["LineageFile"].endswith(
-                    '.gz') else 'cat'
-            handle = sp.Popen(
-                (cmd, argies["LineageFile"]), bufsize=8192, stdout=sp.PIPE).stdout
-            line = read_line(handle)
-            while line:
-                for taxname, taxlist in taxa.items():
-                    if f',{taxname},' in line:
-                        taxlist.append(line.split(',', 1)[0])
-                line = read_line(handle)
+            lineage_index = LineageIndex(argies["LineageFile"]).load()
+            for taxname, taxlist in taxa.items():
+                taxlist.extend(lineage_index.lookup(taxname))
 
     '''Check NCBI TaxIDs to retain/exclude'''
     if not type(argies["ExcludeIds"]) == frozenset:
@@ -0,0 +1,68 @@
+import os
+import shutil
+import hashlib
+
+from app.utils.shell_cmds import loginfo
+
+
+def content_hash(*parts) -> str:
+    '''Stable hex digest of any number of string parts, used as a cache key'''
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class FileCache:
+    '''
+    Content-addressed store of files that are expensive to regenerate, shared between samples and reruns.
+    Entries are looked up by key; the store is bounded to max_mb, evicting least recently used entries first.
+    '''
+
+    def __init__(self, root, max_mb) -> None:
+        self.root = root
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.enabled = self.max_bytes > 0
+        if self.enabled:
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key) -> str:
+        return f"{self.root}/{key}"
+
+    def get(self, key):
+        '''Return path to cached entry (marking it as recently used), or None on a miss'''
+        if not self.enabled or not os.path.isfile(self.path(key)):
+            return None
+        os.utime(self.path(key), None)
+        return self.path(key)
+
+    def put(self, key, src) -> None:
+        '''Copy src into the store under key. Written to a temp file then renamed, so concurrent runs never see a partial entry.'''
+        if not self.enabled:
+            return
+        tmp = f"{self.path(key)}.{os.getpid()}.tmp"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        '''Delete least recently used entries until the store fits in max_mb'''
+        entries = []
+        for fname in os.listdir(self.root):
+            fpath = f"{self.root}/{fname}"
+            if fname.endswith(".tmp") or not os.path.isfile(fpath):
+                continue
+            st = os.stat(fpath)
+            entries.append([st.st_mtime, st.st_size, fpath])
+        total = sum([i[1] for i in entries])
+        for _, size, fpath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            loginfo(f"Evicting {fpath} from cache")
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                '''Already evicted by a concurrent run'''
+                pass
+            total -= size
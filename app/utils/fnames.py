@@ -11,3 +11,20 @@ def get_consensus_fnames(args):
         "collated_reads_fastq": f"{args['folder_stem']}consensus_data/collated_reads.fastq",
         "grouped_reads": f"{args['folder_stem']}grouped_reads.p",
     }
+
+
+def get_intermediate_fnames(args):
+    '''Intermediate files passed between pipeline stages; gzipped if IntermediateCompression'''
+    stem = f"{args['SaveDir']}/{args['ExpName']}/{args['ExpName']}"
+    ext = ".gz" if "IntermediateCompression" in args.keys() and args["IntermediateCompression"] else ""
+    return {
+        "filt_files": [f"{stem}_1_filt.fastq{ext}", f"{stem}_2_filt.fastq{ext}"],
+        "clean_files": [f"{stem}_1_clean.fastq{ext}", f"{stem}_2_clean.fastq{ext}"],
+        "trim_files": [f"{stem}_1_trimmings.fq{ext}", f"{stem}_2_trimmings.fq{ext}"],
+        "bamview": f"{stem}_bamview.txt{ext}",
+    }
+
+
+def get_cache_dir(args, cache_name):
+    '''Caches live under SaveDir so they're shared by every sample in a batch, and by reruns'''
+    return f"{args['SaveDir']}/castanet_cache/{cache_name}"
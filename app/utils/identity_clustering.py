@@ -0,0 +1,60 @@
+import heapq
+from rapidfuzz.distance import Levenshtein
+
+
+def kmer_sketch(seq, k, sketch_size) -> set:
+    '''Bottom-s sketch (smallest n hashes) of a sequence's k-mers'''
+    return set(heapq.nsmallest(sketch_size, {hash(seq[i:i+k]) for i in range(len(seq) - k + 1)}))
+
+
+def sketch_jaccard(a, b, sketch_size) -> float:
+    '''Estimate Jaccard similarity of two seqs' k-mer sets from their bottom-s sketches'''
+    union_sketch = set(heapq.nsmallest(sketch_size, a | b))
+    if len(union_sketch) == 0:
+        return 0.0
+    return len(union_sketch & a & b) / len(union_sketch)
+
+
+def min_jaccard(seq_len, min_identity, k) -> float:
+    '''Lowest k-mer Jaccard two seqs of this length can have and still be within min_identity (each edit breaks <= k k-mers)'''
+    n_kmers = seq_len - k + 1
+    max_broken = int((1 - min_identity) * seq_len) * k
+    if n_kmers <= 0:
+        return 0.0
+    return max(0, n_kmers - max_broken) / (n_kmers + max_broken)
+
+
+def cluster_by_identity(seqs, min_identity=0.97, k=11, sketch_size=64) -> tuple:
+    '''
+    Greedy identity clustering. Takes unique seqs as [[seq, id, count]], most abundant first; each joins the first (most abundant)
+    representative within min_identity, else becomes a new representative. Candidates are prefiltered on k-mer sketch
+    similarity, then checked with a banded edit distance (rapidfuzz, cut off at the max edits allowed).
+    Returns representatives as [[seq, id, cluster count, n unique members]] and memberships as [[id, count, rep id, identity]].
+    '''
+    reps, rep_sketches, memberships = [], [], []
+    for seq, seq_id, count in seqs:
+        sketch = kmer_sketch(seq, k, sketch_size)
+        jaccard_cutoff = min_jaccard(len(seq), min_identity, k) / 2
+        match = None
+        for idx, rep in enumerate(reps):
+            max_len = max(len(seq), len(rep[0]))
+            max_edits = int((1 - min_identity) * max_len)
+            if abs(len(seq) - len(rep[0])) > max_edits:
+                continue
+            if sketch and rep_sketches[idx] and sketch_jaccard(sketch, rep_sketches[idx], sketch_size) < jaccard_cutoff:
+                continue
+            edits = Levenshtein.distance(seq, rep[0], score_cutoff=max_edits)
+            if edits <= max_edits:
+                match = [idx, 1 - edits / max_len]
+                break
+
+        if match is None:
+            reps.append([seq, seq_id, count, 1])
+            rep_sketches.append(sketch)
+            memberships.append([seq_id, count, seq_id, 1.0])
+        else:
+            reps[match[0]][2] += count
+            reps[match[0]][3] += 1
+            memberships.append(
+                [seq_id, count, reps[match[0]][1], round(match[1], 4)])
+    return reps, memberships
@@ -0,0 +1,76 @@
+import os
+import shutil
+import fcntl
+import subprocess as sp
+
+from app.utils.shell_cmds import loginfo, stoperr
+from app.utils.hash_files import hash_me
+from app.utils.file_cache import content_hash
+from app.utils.fnames import get_cache_dir
+from app.utils.mapper_profiles import index_cmd, index_path, index_files
+
+
+def mapper_version(mapper) -> str:
+    '''Version string of mapper, so indices built by a different version are never reused'''
+    cmd = {"bwa": "bwa-mem2 version", "bowtie2": "bowtie2 --version",
+           "minimap2": "minimap2 --version"}[mapper]
+    try:
+        out = sp.run(cmd, shell=True, capture_output=True, text=True)
+        return out.stdout.strip().split("\n")[0]
+    except Exception:
+        return "unknown"
+
+
+class IndexCache:
+    '''
+    Mapping indices shared by every sample in SaveDir, keyed by reference content hash, mapper, mapper version and index preset.
+    Entries are built once under an exclusive file lock, so concurrent samples/batches wait for (then reuse) the same index.
+    An entry only counts as built once its build log has been written, which only happens if the build exited cleanly and
+    left every expected index file: interrupted builds are redone, and failed ones are removed and stop the run.
+    '''
+
+    def __init__(self, p) -> None:
+        self.p = p
+        self.root = get_cache_dir(p, "mapping_indices")
+        '''Minimap2 bakes its preset's k-mer settings into the index'''
+        self.preset = "map-ont" if p["Mapper"] == "minimap2" and p["SingleEndedReads"] else "default"
+        self.key = content_hash(hash_me(p["RefStem"]).hex(), p["Mapper"],
+                                mapper_version(p["Mapper"]), self.preset)
+        self.entry = f"{self.root}/{self.key}"
+        self.log = f"{self.entry}/build.log"
+
+    def index_path(self) -> str:
+        '''Path to pass to mapper in place of the reference'''
+        return index_path(self.p["Mapper"], f"{self.entry}/ref.fa")
+
+    def build_cmd(self) -> str:
+        return index_cmd(self.p["Mapper"], f"{self.entry}/ref.fa", self.p["NThreads"], self.preset == "map-ont")
+
+    def get(self) -> tuple:
+        '''Return (index path, build log), building the index first if no other run has'''
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{self.entry}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(self.log):
+                loginfo(
+                    f"Building {self.p['Mapper']} index for {self.p['RefStem']} in {self.entry} (reused by later samples and runs)")
+                if os.path.exists(self.entry):
+                    shutil.rmtree(self.entry)
+                os.makedirs(self.entry)
+                shutil.copyfile(self.p["RefStem"], f"{self.entry}/ref.fa")
+                build = sp.run(self.build_cmd(), shell=True, capture_output=True)
+                out = str(build.stdout + build.stderr)
+                missing = [i for i in index_files(self.p["Mapper"], f"{self.entry}/ref.fa")
+                           if not os.path.isfile(i)]
+                if build.returncode != 0 or missing:
+                    shutil.rmtree(self.entry)
+                    stoperr(f"Building {self.p['Mapper']} index for {self.p['RefStem']} failed (exit code {build.returncode}"
+                            f"{', missing ' + ', '.join([os.path.basename(i) for i in missing]) if missing else ''}). Tool's error message: {out}")
+                with open(f"{self.log}.tmp", "w") as f:
+                    f.write(out)
+                os.replace(f"{self.log}.tmp", self.log)
+            else:
+                loginfo(f"Reusing cached {self.p['Mapper']} index {self.entry}")
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        with open(self.log) as f:
+            return self.index_path(), f.read()
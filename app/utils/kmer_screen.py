@@ -0,0 +1,78 @@
+import os
+import numpy as np
+
+from app.utils.shell_cmds import loginfo
+from app.utils.hash_files import hash_me
+from app.utils.file_cache import content_hash
+from app.utils.fnames import get_cache_dir
+from app.utils.utility_fns import stream_fa
+
+PRESCREEN_K = 21  # RM < TODO Parameterise
+
+'''2 bit base codes; anything other than ACGT (incl. N and the separator between seqs) is 4, and breaks k-mers'''
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b"ACGTacgt", [0, 1, 2, 3, 0, 1, 2, 3]):
+    BASE_CODES[base] = code
+
+
+def canonical_kmers(seqs, k=PRESCREEN_K) -> tuple:
+    '''
+    Every valid k-mer (k <= 32) of a list of sequences, 2 bit packed as uint64 and canonical (min of fwd and rev comp).
+    Computed for all sequences at once, k numpy ops in total. Returns (kmers, index of sequence each k-mer came from).
+    '''
+    if len(seqs) == 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    codes = BASE_CODES[np.frombuffer("\n".join(seqs).encode("utf-8"), dtype=np.uint8)]
+    n_kmers = len(codes) - k + 1
+    if n_kmers < 1:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    bases = (codes & 3).astype(np.uint64)
+    fwd, rev = np.zeros(n_kmers, dtype=np.uint64), np.zeros(n_kmers, dtype=np.uint64)
+    for j in range(k):
+        fwd = (fwd << np.uint64(2)) | bases[j:j + n_kmers]
+        rev |= (np.uint64(3) - bases[j:j + n_kmers]) << np.uint64(2 * j)
+    '''K-mer at i is valid if no invalid codes among codes i..i+k-1'''
+    n_bad = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = (n_bad[k:k + n_kmers] - n_bad[0:n_kmers]) == 0
+    seq_idx = np.repeat(np.arange(len(seqs)), [len(i) + 1 for i in seqs])[0:n_kmers]
+    return np.minimum(fwd, rev)[valid], seq_idx[valid]
+
+
+class KmerPanel:
+    '''
+    Sorted, unique canonical k-mers of every sequence in RefStem, for cheaply screening reads for any chance of mapping.
+    Built once per panel and cached (as .npy, memory mapped on load) under SaveDir, keyed by RefStem content hash and k.
+    '''
+
+    def __init__(self, p, k=PRESCREEN_K) -> None:
+        self.k = k
+        self.ref = p["RefStem"]
+        self.fname = f"{get_cache_dir(p, 'kmer_panels')}/{content_hash(hash_me(self.ref).hex(), self.k)}.npy"
+        self.kmers = None
+
+    def build(self) -> None:
+        '''Written to a temp file then renamed, so concurrent samples never see a partial index'''
+        loginfo(
+            f"Building {self.k}-mer index for {self.ref} (one-off, reused by later samples and runs)")
+        kmers = [np.unique(canonical_kmers([seq], self.k)[0])
+                 for _, seq in stream_fa(self.ref)]
+        kmers = np.unique(np.concatenate(kmers)) if kmers else np.empty(0, dtype=np.uint64)
+        os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+        tmp = f"{self.fname}.{os.getpid()}.tmp.npy"
+        np.save(tmp, kmers)
+        os.replace(tmp, self.fname)
+
+    def load(self):
+        if not os.path.exists(self.fname):
+            self.build()
+        self.kmers = np.load(self.fname, mmap_mode="r")
+        return self
+
+    def screen(self, seqs, min_hits) -> np.ndarray:
+        '''Boolean mask of seqs sharing at least min_hits k-mers with the panel'''
+        if len(self.kmers) == 0:
+            return np.zeros(len(seqs), dtype=bool)
+        kmers, seq_idx = canonical_kmers(seqs, self.k)
+        pos = np.minimum(np.searchsorted(self.kmers, kmers), len(self.kmers) - 1)
+        hit = self.kmers[pos] == kmers
+        return np.bincount(seq_idx[hit], minlength=len(seqs)) >= min_hits
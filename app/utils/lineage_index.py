@@ -0,0 +1,89 @@
+import os
+import shutil
+import hashlib
+import platform
+import numpy as np
+import subprocess as sp
+from array import array
+
+from app.utils.shell_cmds import loginfo, read_line
+from app.utils.hash_files import hash_me
+
+
+def name_hash(name) -> int:
+    '''Stable signed 64-bit hash of a taxon name (persisted in the index, so can't use Python's salted str hash)'''
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class LineageIndex:
+    '''
+    Name -> taxid lookup over an NCBI lineage CSV, built once and saved next to it, keyed by the lineage file's hash.
+    A taxid is returned for a name if the name is any of its lineage ranks (as the ",{name}," substring search it replaces).
+    Stored CSR style as three .npy arrays, memory mapped on load: sorted name hashes, offsets into taxids, taxids.
+    '''
+
+    def __init__(self, lineage_fname) -> None:
+        self.lineage_fname = lineage_fname
+        self.index_dir = f"{lineage_fname}.index_{hash_me(lineage_fname).hex()}"
+        self.names, self.offsets, self.taxids = None, None, None
+
+    def cmd_string(self):
+        if platform.system() == "Darwin":
+            return 'gzcat' if self.lineage_fname.endswith('.gz') else 'cat'
+        else:
+            return 'zcat' if self.lineage_fname.endswith('.gz') else 'cat'
+
+    def build(self) -> None:
+        '''Stream lineage file once, save index. Built in a temp dir then renamed, so concurrent samples never see a partial index.'''
+        loginfo(
+            f"Building lineage index for {self.lineage_fname} (one-off, reused by later runs)")
+        hashes, taxids = array("q"), array("q")
+        handle = sp.Popen((self.cmd_string(), self.lineage_fname),
+                          bufsize=8192, stdout=sp.PIPE).stdout
+        line = read_line(handle)
+        while line:
+            fields = line.rstrip("\n").split(",")
+            try:
+                taxid = int(fields[0])
+            except ValueError:
+                '''Header'''
+                line = read_line(handle)
+                continue
+            '''Only interior fields sit between two commas'''
+            for name in set(fields[1:-1]):
+                if name:
+                    hashes.append(name_hash(name))
+                    taxids.append(taxid)
+            line = read_line(handle)
+
+        hashes, taxids = np.frombuffer(hashes, dtype=np.int64), np.frombuffer(taxids, dtype=np.int64)
+        order = np.argsort(hashes, kind="stable")
+        names, starts = np.unique(hashes[order], return_index=True)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+
+        tmp_dir = f"{self.index_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(f"{tmp_dir}/names.npy", names)
+        np.save(f"{tmp_dir}/offsets.npy", offsets)
+        np.save(f"{tmp_dir}/taxids.npy", taxids[order])
+        try:
+            os.rename(tmp_dir, self.index_dir)
+        except OSError:
+            '''Another run finished building it first'''
+            shutil.rmtree(tmp_dir)
+
+    def load(self):
+        if not os.path.exists(self.index_dir):
+            self.build()
+        self.names = np.load(f"{self.index_dir}/names.npy", mmap_mode="r")
+        self.offsets = np.load(f"{self.index_dir}/offsets.npy", mmap_mode="r")
+        self.taxids = np.load(f"{self.index_dir}/taxids.npy", mmap_mode="r")
+        return self
+
+    def lookup(self, name) -> list:
+        '''Taxids (as str) of every taxon with name in its lineage'''
+        query = name_hash(name)
+        idx = int(np.searchsorted(self.names, query))
+        if idx == len(self.names) or self.names[idx] != query:
+            return []
+        return [str(i) for i in self.taxids[self.offsets[idx]:self.offsets[idx + 1]]]
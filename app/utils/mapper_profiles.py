@@ -0,0 +1,97 @@
+import os
+
+'''
+One definition per mapper of how to index a reference and map reads to it, from which every mapping pipeline
+(initial mapping, streamed mapping, remapping to consensus) is built.
+'''
+MAPPER_PROFILES = {
+    "bwa": {
+        "tool": "bwa-mem2",
+        "index": lambda ref, threads, single: f"bwa-mem2 index {ref}",
+        "index_path": lambda ref: ref,
+        "index_files": [".0123", ".amb", ".ann", ".bwt.2bit.64", ".pac"],
+        "map": lambda index, reads, threads, single: f"bwa-mem2 mem -t {threads} {index} {' '.join(reads)}",
+        "view_flags": "-F4",
+    },
+    "bowtie2": {
+        "tool": "bowtie2",
+        "index": lambda ref, threads, single: f"bowtie2-build --large-index --threads {threads} {ref} {ref}",
+        "index_path": lambda ref: ref,
+        "index_files": [".1.bt2l", ".2.bt2l", ".3.bt2l", ".4.bt2l", ".rev.1.bt2l", ".rev.2.bt2l"],
+        "map": lambda index, reads, threads, single:
+            f"bowtie2 -x {index} {f'-U {reads[0]}' if single else f'-1 {reads[0]} -2 {reads[1]}'} "
+            f"-p {threads} --local -I 50 --maxins 2000 --no-unal",
+        "view_flags": "-h -F4 -F2048",
+    },
+    "minimap2": {
+        "tool": "minimap2",
+        # Minimap2 bakes its preset's k-mer settings into the index, so index and map presets must match
+        "index": lambda ref, threads, single: f"minimap2 {'-x map-ont ' if single else ''}-t {threads} -d {ref}.mmi {ref}",
+        "index_path": lambda ref: f"{ref}.mmi",
+        "index_files": [".mmi"],
+        "map": lambda index, reads, threads, single: f"minimap2 {'-ax map-ont' if single else '-a'} -t {threads} {index} {' '.join(reads)}",
+        "view_flags": "-F4",
+    },
+}
+
+'''Sort memory per samtools sort thread, capped so all sort threads together use at most SORT_MEM_FRAC of RAM'''
+SORT_MEM_MB = 768  # RM < TODO Parameterise
+SORT_MEM_FRAC = 0.25
+
+
+def thread_budget(n_threads) -> dict:
+    '''
+    Split NThreads between the processes of a mapping pipeline, rather than giving each all of them.
+    Samtools "-@" is threads in addition to its main one, so (above 2 threads) the main threads of view and sort come out
+    of the mapper's share, and view and sort only get extras once there are threads to spare.
+    '''
+    n_threads = max(1, int(n_threads))
+    extra = n_threads // 8
+    n_main = 2 if n_threads > 2 else 0
+    return {"mapper": max(1, n_threads - n_main - 2 * extra), "view": extra, "sort": extra}
+
+
+def sort_mem_mb(n_sort_threads) -> int:
+    '''Per thread memory for samtools sort: default, unless that would oversubscribe a small node'''
+    try:
+        total_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return SORT_MEM_MB
+    return int(max(64, min(SORT_MEM_MB, total_mb * SORT_MEM_FRAC // (n_sort_threads + 1))))
+
+
+def index_cmd(mapper, ref, n_threads, single_ended) -> str:
+    return MAPPER_PROFILES[mapper]["index"](ref, max(1, int(n_threads)), single_ended)
+
+
+def index_path(mapper, ref) -> str:
+    '''Path to pass to mapper in place of ref, once ref has been indexed'''
+    return MAPPER_PROFILES[mapper]["index_path"](ref)
+
+
+def index_files(mapper, ref) -> list:
+    '''Files a successful index build of ref leaves'''
+    return [f"{ref}{i}" for i in MAPPER_PROFILES[mapper]["index_files"]]
+
+
+def map_cmd(mapper, index, reads, n_threads, single_ended) -> str:
+    '''Mapper command alone, writing SAM to stdout'''
+    return MAPPER_PROFILES[mapper]["map"](index, reads, max(1, int(n_threads)), single_ended)
+
+
+def map_to_bam_cmd(mapper, index, reads, out_bam, n_threads, tmp_prefix) -> str:
+    '''Map reads (1 or 2 files) and convert to coordinate sorted BAM of mapped reads, sharing n_threads between tools'''
+    threads = thread_budget(n_threads)
+    single = len(reads) == 1
+    return (f"{map_cmd(mapper, index, reads, threads['mapper'], single)} | "
+            f"samtools view -@ {threads['view']} {MAPPER_PROFILES[mapper]['view_flags']} -Sb - | "
+            f"samtools sort -@ {threads['sort']} -m {sort_mem_mb(threads['sort'])}M -T {tmp_prefix} - 1> {out_bam}")
+
+
+def remap_cmd(mapper, index, in_bam, n_threads) -> str:
+    '''Remap reads in in_bam (as a single stream) to index, writing SAM to stdout'''
+    threads = thread_budget(n_threads)
+    '''Samtools fastq takes its main thread plus view's extras; mapper the rest'''
+    n_mapper = max(1, int(n_threads) - 1 - threads["view"])
+    return (f"samtools fastq -@ {threads['view']} {in_bam} | "
+            f"{map_cmd(mapper, index, ['-'], n_mapper, True)}")
@@ -0,0 +1,128 @@
+import re
+import numpy as np
+import subprocess as sp
+from collections import Counter
+
+from app.utils.shell_cmds import stoperr
+
+'''Columns of per-position count arrays'''
+PILEUP_COLS = ["A", "C", "G", "T", "-", "N"]
+READ_START = re.compile(r"\^.", re.S)
+INDEL = re.compile(r"[+-](\d+)")
+
+
+class TargetPileup:
+    '''
+    Per-position base counts for one target of an indexed bam, from a single samtools mpileup pass over its region.
+    Coverage stats (as samtools coverage) and a majority rule naive consensus (in place of samtools consensus) are both derived from the counts.
+    '''
+
+    def __init__(self, target) -> None:
+        self.target = target
+        self.counts = np.zeros((0, len(PILEUP_COLS)), dtype=np.int32)
+        self.insertions = {}
+        self.read_mapqs = []
+        self.baseq_sum, self.baseq_n = 0, 0
+
+    def run(self, bam_fname):
+        '''Stream mpileup for target region (all positions; no BAQ, base quality or depth caps; orphan reads kept, as samtools coverage)'''
+        proc = sp.Popen(["samtools", "mpileup", "-a", "-A", "-B", "-Q", "0", "-d", "0", "-r", self.target, bam_fname],
+                        stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+        self.parse(proc.stdout)
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            stoperr(
+                f"Castanet failed to call pileup for target {self.target}. Samtools error: {err}")
+        return self
+
+    def strip_indels(self, bases) -> tuple:
+        '''Remove indel tokens (e.g. +2AG, -1c) from an mpileup bases column; return remaining bases and inserted seqs'''
+        out, ins, i = [], [], 0
+        for m in INDEL.finditer(bases):
+            if m.start() < i:
+                continue
+            out.append(bases[i:m.start()])
+            i = m.end() + int(m.group(1))
+            if m.group(0)[0] == "+":
+                ins.append(bases[m.end():i].upper())
+        out.append(bases[i:])
+        return "".join(out), ins
+
+    def parse(self, lines):
+        '''Count bases at each position of mpileup output (chrom, pos, ref, depth, bases, quals)'''
+        rows = []
+        for line in lines:
+            fields = line.rstrip("\n").split("\t")
+            ref_base, bases = fields[2].upper(), fields[4]
+            '''Read start markers carry the read's MapQ'''
+            self.read_mapqs.extend([ord(i[1]) - 33 for i in READ_START.findall(bases)])
+            bases = READ_START.sub("", bases).replace("$", "")
+            if "+" in bases or "-" in bases:
+                bases, ins = self.strip_indels(bases)
+                if ins:
+                    self.insertions[len(rows)] = ins
+            bases = bases.upper()
+            row = [bases.count(i) for i in ["A", "C", "G", "T"]] + \
+                [bases.count("*") + bases.count("#"), bases.count("N")]
+            '''Matches to reference (only given if mpileup had a reference)'''
+            n_ref = bases.count(".") + bases.count(",")
+            row[PILEUP_COLS.index(ref_base) if ref_base in PILEUP_COLS[0:4] else 5] += n_ref
+            rows.append(row)
+            if len(fields) > 5 and fields[5] != "*":
+                self.baseq_sum += sum(fields[5].encode()) - 33 * len(fields[5])
+                self.baseq_n += len(fields[5])
+        if rows:
+            self.counts = np.array(rows, dtype=np.int32)
+        return self
+
+    def depth(self) -> np.ndarray:
+        '''Read depth at each position, excluding deletions (as samtools depth/coverage)'''
+        return self.counts[:, [0, 1, 2, 3, 5]].sum(axis=1)
+
+    def coverage(self) -> list:
+        '''Row in samtools coverage format: #rname, startpos, endpos, numreads, covbases, coverage, meandepth, meanbaseq, meanmapq'''
+        n_pos = self.counts.shape[0]
+        depth = self.depth()
+        covbases = int((depth > 0).sum())
+        return [self.target, 1, n_pos, len(self.read_mapqs), covbases,
+                covbases / n_pos * 100 if n_pos else 0.0,
+                float(depth.mean()) if n_pos else 0.0,
+                self.baseq_sum / self.baseq_n if self.baseq_n else 0.0,
+                float(np.mean(self.read_mapqs)) if self.read_mapqs else 0.0]
+
+    def consensus(self, min_d, reference_coords=False) -> str:
+        '''
+        Simple majority rule consensus (not samtools consensus' default Bayesian model, so mixed positions may be called
+        differently); positions under min_d depth are N. Laid out as samtools consensus did: uncovered positions skipped
+        (so uncovered ends trimmed), deletions dropped, majority insertions added.
+        With reference_coords, one base per reference position (as samtools consensus -a --show-ins no --show-del yes).
+        '''
+        if self.counts.shape[0] == 0:
+            return ""
+        total = self.counts.sum(axis=1)
+        '''N bases are coverage but not evidence: depth for calling is ACGT and deletions only, so an all N position is N'''
+        called = self.counts[:, 0:5].sum(axis=1)
+        calls = np.array(PILEUP_COLS)[self.counts[:, 0:5].argmax(axis=1)]
+        calls[called < max(min_d, 1)] = "N"
+        if reference_coords:
+            calls[calls == "-"] = "*"
+            return "".join(calls)
+
+        seq = []
+        for i in np.flatnonzero(total > 0):
+            if calls[i] != "-":
+                seq.append(calls[i])
+            if i in self.insertions.keys() and called[i] >= min_d and len(self.insertions[i]) * 2 > called[i]:
+                seq.append(Counter(self.insertions[i]).most_common()[0][0])
+        return "".join(seq)
+
+
+def save_pileups(fname, pileups) -> None:
+    '''Persist per-target count arrays (columns as PILEUP_COLS) for use by other stages'''
+    np.savez_compressed(fname, **{k: v.counts for k, v in pileups.items()})
+
+
+def load_pileups(fname) -> dict:
+    '''Load per-target count arrays saved by save_pileups'''
+    with np.load(fname) as f:
+        return {k: f[k] for k in f.files}
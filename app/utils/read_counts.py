@@ -0,0 +1,28 @@
+import os
+import pandas as pd
+
+from app.utils.shell_cmds import loginfo
+
+'''Stages whose read counts are recorded (reads, or read pairs, in R1), in pipeline order'''
+READ_COUNT_STAGES = ["raw", "post_prescreen", "post_filter", "post_trim"]
+
+
+def read_counts_fname(p) -> str:
+    return f"{p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_read_counts.csv"
+
+
+def get_read_counts(p) -> dict:
+    '''Read counts recorded so far for this experiment, as {stage: n}'''
+    if not os.path.exists(read_counts_fname(p)):
+        return {}
+    df = pd.read_csv(read_counts_fname(p))
+    return dict(zip(df["stage"], df["n_reads"].astype(int)))
+
+
+def record_read_count(p, stage, n_reads) -> None:
+    '''Save count for a stage, as counted by the stage itself while streaming reads (so no stage exists only to count)'''
+    counts = get_read_counts(p)
+    counts[stage] = int(n_reads)
+    loginfo(f"Read count ({stage}): {n_reads}")
+    pd.DataFrame([[i, counts[i]] for i in READ_COUNT_STAGES if i in counts.keys()],
+                 columns=["stage", "n_reads"]).to_csv(read_counts_fname(p), index=False)
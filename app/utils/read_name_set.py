@@ -0,0 +1,46 @@
+import numpy as np
+from array import array
+
+
+def hash_names(names) -> np.ndarray:
+    '''64-bit hashes of read names. Python's str hash is salted per process, so hashes are only comparable within one run.'''
+    return np.fromiter((hash(i) for i in names), dtype=np.int64)
+
+
+class ReadNameSet:
+    '''
+    Compact set of read names, held as a sorted array of 64-bit name hashes (8 bytes per read, vs ~100 for a str in a frozenset).
+    Names are added while streaming, then frozen for vectorised lookup. Distinct names only collide
+    with ~n^2/2^64 probability, i.e. negligible for any sample size.
+    '''
+
+    def __init__(self) -> None:
+        self.buffer = array("q")
+        self.hashes = np.zeros(0, dtype=np.int64)
+
+    def add(self, name) -> None:
+        self.buffer.append(hash(name))
+
+    def freeze(self):
+        '''Sort and deduplicate added hashes; call once all names have been added'''
+        self.hashes = np.unique(np.concatenate(
+            [self.hashes, np.frombuffer(self.buffer, dtype=np.int64)]))
+        self.buffer = array("q")
+        return self
+
+    def contains(self, names) -> np.ndarray:
+        '''Boolean mask of which names are in the set'''
+        queries = hash_names(names)
+        if len(self.hashes) == 0:
+            return np.zeros(len(queries), dtype=bool)
+        idx = np.searchsorted(self.hashes, queries)
+        idx[idx == len(self.hashes)] = 0
+        return self.hashes[idx] == queries
+
+    def __contains__(self, name) -> bool:
+        query = hash(name)
+        idx = np.searchsorted(self.hashes, query)
+        return bool(idx < len(self.hashes) and self.hashes[idx] == query)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
@@ -26,11 +26,8 @@ class SimilarityGraph:
     def construct_matrix(self, trace_code):
         '''Accepts codified sequence, generates subst matrix and calls similarity scorer'''
         matrix = align.SubstitutionMatrix.std_nucleotide_matrix()
-        similarities = np.zeros(trace_code.shape)
-        for i in range(similarities.shape[0]):
-            for j in range(similarities.shape[1]):
-                similarities[i, j] = self.get_average_normalized_similarity(
-                    trace_code, matrix.score_matrix(), i, j)
+        similarities = self.get_average_normalized_similarity(
+            trace_code, matrix.score_matrix())
 
         with warnings.catch_warnings():
             # Catch warnings about empty slice for gap-only parts
@@ -39,37 +36,41 @@ class SimilarityGraph:
 
         return similarities
 
-    def get_average_normalized_similarity(self, trace_code, matrix, seq_i, pos_i):
-        '''Calculate avg norm similarity score'''
-        code1 = trace_code[seq_i, pos_i]
-        if code1 == -1:
-            return np.nan
-        similarities = np.zeros(trace_code.shape[0])
-        for i in range(trace_code.shape[0]):
-            code2 = trace_code[i, pos_i]
-            if code2 == -1:
-                similarities[i] = 0
-            else:
-                sim = matrix[code1, code2]
-                # Normalize (range 0.0 - 1.0)
-                min_sim = np.min(matrix[code1])
-                max_sim = np.max(matrix[code1])
-                sim = (sim - min_sim) / (max_sim - min_sim)
-                similarities[i] = sim
-        # Delete self-similarity
-        similarities = np.delete(similarities, seq_i)
-        return np.average(similarities)
+    def get_average_normalized_similarity(self, trace_code, matrix):
+        '''Calculate avg norm similarity score of every (seq, pos) against all other seqs at pos (gaps score 0, nan for gapped cells)'''
+        n_seqs, n_pos = trace_code.shape
+        if n_seqs < 2:
+            return np.full(trace_code.shape, np.nan)
+        # Normalize (range 0.0 - 1.0), per row of subst matrix
+        matrix = matrix.astype(float)
+        min_sim, max_sim = matrix.min(axis=1, keepdims=True), matrix.max(axis=1, keepdims=True)
+        norm_matrix = (matrix - min_sim) / (max_sim - min_sim)
+        '''Count of each code per column, so column totals for any code are one matrix product rather than a pass over all seqs'''
+        gaps = trace_code == -1
+        codes = np.where(gaps, 0, trace_code)
+        code_counts = np.zeros((n_pos, matrix.shape[0]))
+        np.add.at(code_counts, (np.broadcast_to(
+            np.arange(n_pos), codes.shape)[~gaps], codes[~gaps]), 1)
+        col_totals = code_counts @ norm_matrix.T
+        '''Gather each cell's column total, delete self-similarity, average over other seqs'''
+        similarities = (col_totals[np.arange(n_pos), codes] -
+                        norm_matrix[codes, codes]) / (n_seqs - 1)
+        similarities[gaps] = np.nan
+        return similarities
 
     def calculate_bins(self, similarities, bin_count):
         '''Auto-scale bins to data'''
-        edges = np.linspace(0, similarities.shape[1], bin_count, dtype=int)
-        edges = np.append(edges, similarities.shape[1])
-        binned_similarities = np.zeros(similarities.shape)
-        for i in range(similarities.shape[0]):
-            for j in range(len(edges) - 1):
-                binned_similarities[i, edges[j]:edges[j+1]] = \
-                    np.nanmean(similarities[i, edges[j]:edges[j+1]])
-        return binned_similarities
+        n_pos = similarities.shape[1]
+        if n_pos == 0:
+            return similarities
+        edges = np.linspace(0, n_pos, bin_count, dtype=int)
+        '''Non-empty bins only'''
+        starts = np.unique(edges[edges < n_pos])
+        measured = ~np.isnan(similarities)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bin_means = np.add.reduceat(np.where(measured, similarities, 0), starts, axis=1) / \
+                np.add.reduceat(measured.astype(int), starts, axis=1)
+        return np.repeat(bin_means, np.diff(np.append(starts, n_pos)), axis=1)
 
     def draw_figure(self, seq_dict, similarities):
         '''Draw figure'''
@@ -1,4 +1,6 @@
 import os
+import gzip
+import shutil
 import pandas as pd
 from app.utils.shell_cmds import stoperr, logerr
 
@@ -50,6 +52,58 @@ def read_fa(fpath):
     return [i for i in seqs_split if not i == [""]]
 
 
+def stream_fa(fpath):
+    '''Yield fasta records one at a time in format [>name, seq], without holding the whole file in memory'''
+    header, seq = None, []
+    with open(fpath, "r") as f:
+        for l in f:
+            l = l.rstrip("\n")
+            if l.startswith(">"):
+                if header is not None:
+                    yield [header, "".join(seq)]
+                header, seq = l, []
+            else:
+                seq.append(l)
+    if header is not None:
+        yield [header, "".join(seq)]
+
+
+def stream_fastq_blocks(handle, block_size=4194304):
+    '''
+    Yield FASTQ records from a binary handle in bulk: reads block_size bytes at a time, cuts at the last complete record
+    and yields its lines as a flat list (header, seq, "+", qual, header, ...). ASSUMES NO BLANK LINES IN INPUT.
+    '''
+    leftover = []
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        lines = block.decode("utf-8").split("\n")
+        '''Last line of previous block was partial, so continues into this one'''
+        if leftover:
+            lines[0] = leftover.pop() + lines[0]
+            lines = leftover + lines
+        n_complete = (len(lines) - 1) // 4 * 4
+        leftover = lines[n_complete:]
+        if n_complete:
+            yield lines[0:n_complete]
+    leftover = [i for i in leftover if i]
+    if leftover:
+        yield leftover
+
+
+def compress_cmd(n_threads=1) -> str:
+    '''Fast gzip compressor for intermediate files writing stdin to stdout: multithreaded pigz if installed, else gzip'''
+    if shutil.which("pigz"):
+        return f"pigz -1 -p {max(1, int(n_threads))} -c"
+    return "gzip -1 -c"
+
+
+def open_intermediate(fname):
+    '''Open intermediate text file for reading, whether or not it was compressed'''
+    return gzip.open(fname, "rt") if fname.endswith(".gz") else open(fname)
+
+
 def save_fa(fpath, pat):
     with open(fpath, "w") as f:
         f.write(pat)
@@ -63,6 +117,11 @@ def trim_long_fpaths(key, max_len=100):
         return key
 
 
+def normalise_ref_name(name, max_len=100):
+    '''Normalise a mapping reference/target name for dictionary lookups: drop ">" and any fasta description, lower case, curtail'''
+    return trim_long_fpaths(name.replace(">", "").split(" ")[0].lower(), max_len)
+
+
 def enumerate_read_files(exp_dir, single_ended_reads=False, batch_name=None):
     if not exp_dir[-1] == "/":
         exp_dir = f"{exp_dir}/"
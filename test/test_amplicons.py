@@ -0,0 +1,52 @@
+import os
+import shutil
+import pandas as pd
+
+from test.utils import get_default_args, make_rand_dir
+from app.src.amplicons import Amplicons
+
+
+def init_amplicons():
+    p = get_default_args()
+    fstem = make_rand_dir()
+    p["SaveDir"], p["ExpName"] = fstem, "amp"
+    os.mkdir(f"{fstem}/amp")
+    return Amplicons(p), fstem
+
+
+def test_filt():
+    amp, fstem = init_amplicons()
+    seq = "A" * 5 + "C" * 50 + "G" * 3
+    # [seqid, refname, cigar, seq]
+    batch = pd.DataFrame([["r1", "t1", "5S50M3S", seq],
+                          ["r2", "t1", "2H5S53M", seq],
+                          ["r3", "t2", "20M", "C" * 20],
+                          ["r4", "t2", "58M", seq]], columns=[0, 2, 5, 9])
+    stats = amp.crunch([batch.iloc[0:2], batch.iloc[2:]])
+    assert stats == {"t1": 2, "t2": 2}
+    '''Soft clips sliced off, short reads dropped'''
+    assert amp.results["t1"] == {"C" * 50: ["t1_r1", 0, 1],
+                                 "C" * 50 + "G" * 3: ["t1_r2", 1, 1]}
+    assert amp.results["t2"] == {seq: ["t2_r4", 0, 1]}
+    '''Soft clips retained'''
+    amp.results, amp.total_reads, amp.delete_softclips = {}, {}, False
+    amp.filt(batch)
+    assert amp.results["t1"] == {seq: ["t1_r1", 0, 2]}
+    shutil.rmtree(fstem)
+
+
+def test_add_read():
+    amp, fstem = init_amplicons()
+    [amp.add_read("t1", f"r{idx}", seq)
+     for idx, seq in enumerate(["AAA", "CCC", "CCC", "GGG", "AAA", "CCC"])]
+    assert amp.total_reads["t1"] == 6
+    '''Most abundant first, ties in read order'''
+    assert amp.by_abundance("t1") == [["CCC", "t1_r1", 1, 3],
+                                      ["AAA", "t1_r0", 0, 2],
+                                      ["GGG", "t1_r3", 3, 1]]
+    shutil.rmtree(fstem)
+
+
+if __name__ == "__main__":
+    test_filt()
+    test_add_read()
@@ -1,5 +1,8 @@
+import pytest
 import os
 import shutil
+import stat
+import pandas as pd
 
 from test.utils import get_random_str, make_rand_dir, get_default_args
 from app.utils.utility_fns import read_fa
@@ -8,6 +11,12 @@ from app.src.analysis import Analysis
 from app.src.generate_counts import run_counts
 from app.src.map_reads_to_ref import run_map
 from app.utils.mapping_ref_convert import MappingRefConverter
+from app.utils.pileup import TargetPileup
+
+'''Stands in for samtools view: reads a sam as is, or writes one (failing, without reading it all, if out name has FAIL in it)'''
+FAKE_SAMTOOLS = '''#!/bin/bash
+if [ "$2" == "-h" ]; then cat "$5"; else case "$4" in *FAIL*) head -c 1 > /dev/null; echo "writer failed" >&2; exit 3;; *) cat > "$4";; esac; fi
+'''
 
 
 def init_map(p):
@@ -57,6 +66,65 @@ def init_consensus(infile=None):
     shutil.rmtree(fstem)
 
 
+def make_pileup(target, depths, mapq="I"):
+    '''Pileup from mpileup lines with given per-position depths (all reads matching ref, starting at position 1 with mapq)'''
+    return TargetPileup(target).parse([f"{target}\t{i + 1}\tA\t{d}\t{('^' + mapq + '.') * d if i == 0 else '.' * d}\t{'I' * d}\n"
+                                       for i, d in enumerate(depths)])
+
+
+def test_plan_consensus():
+    '''
+    Plan uses bam (per mate) depth, as consensus calling does. Org1 has 5 fully overlapping read pairs: depth 5 counted per
+    pair (as Analysis does) but 10 per mate, so it can pass ConsensusMinD = 10. Org2's 16 mates never overlap, so can't; Org3's second target
+    is too sparse; Org4's target is under ConsensusMapQ; Org5 has too few mapped reads to be piled up at all.
+    '''
+    fstem = make_rand_dir()
+    clf = Consensus.__new__(Consensus)
+    clf.a = {"folder_stem": fstem, "ConsensusMinD": 10, "ConsensusCoverage": 10, "ConsensusMapQ": 30}
+    clf.probetype_index = {"org1_t1": "org1", "org2_t1": "org2", "org3_t1": "org3", "org3_t2": "org3",
+                           "org4_t1": "org4", "org5_t1": "org5"}
+    read_counts = {"org1_t1": 10, "org2_t1": 16, "org3_t1": 12, "org3_t2": 1, "org4_t1": 12, "org5_t1": 9, "other_t1": 20}
+    to_pileup = clf.gate_pileups(["ORG1_t1", "ORG2_t1", "ORG3_t1", "ORG3_t2", "ORG4_t1", "ORG5_t1", "other_t1"], read_counts)
+    assert to_pileup == ["ORG1_t1", "ORG2_t1", "ORG3_t1", "ORG3_t2", "ORG4_t1"]
+    clf.pileups = {"ORG1_t1": make_pileup("ORG1_t1", [10] * 50 + [0] * 50),
+                   "ORG2_t1": make_pileup("ORG2_t1", [8] * 100),
+                   "ORG3_t1": make_pileup("ORG3_t1", [12] * 100),
+                   "ORG3_t2": make_pileup("ORG3_t2", [12] * 5 + [0] * 95),
+                   "ORG4_t1": make_pileup("ORG4_t1", [12] * 100, mapq="+")}
+    assert clf.plan_consensus() == ["ORG1_t1", "ORG3_t1"]
+    plan = pd.read_csv(f"{fstem}/consensus_plan.csv")
+    assert plan.shape[0] == 7 and plan["planned"].sum() == 2
+    shutil.rmtree(fstem)
+
+
+
+def test_split_bam_by_organism(monkeypatch):
+    '''Every per-organism writer is checked, and tool messages can't block the split'''
+    fstem, bin_dir = make_rand_dir(), make_rand_dir()
+    with open(f"{bin_dir}/samtools", "w") as f:
+        f.write(FAKE_SAMTOOLS)
+    os.chmod(f"{bin_dir}/samtools", stat.S_IRWXU)
+    monkeypatch.setenv("PATH", f"{os.path.abspath(bin_dir)}:{os.environ['PATH']}")
+    with open(f"{fstem}/master.sam", "w") as f:
+        f.write("@HD\tVN:1.6\n" + "".join([f"r{i}\t0\t{'ORG1_t1' if i % 2 else 'ORG2_t1'}\t1\t{60 if i % 4 else 0}\t*\n"
+                                          for i in range(20000)]))
+    for orgs in [{"ORG1": ["ORG1_t1"], "ORG2": ["ORG2_t1"]}, {"ORG1": ["ORG1_t1"], "FAIL": ["ORG2_t1"]}]:
+        clf = Consensus.__new__(Consensus)
+        clf.a = {"folder_stem": fstem, "ConsensusMapQ": 30, "NThreads": 2}
+        clf.fnames = {"master_bam": f"{fstem}/master.sam"}
+        clf.eval_stats, clf.organism_filters = {}, {}
+        clf.filter_bam_to_organism = lambda org_name: (orgs[org_name],)
+        if "FAIL" in orgs.keys():
+            with pytest.raises(SystemError):
+                clf.split_bam_by_organism(list(orgs.keys()))
+        else:
+            clf.split_bam_by_organism(list(orgs.keys()))
+            assert clf.eval_stats == {"ORG1": {"filtered_collated_read_num": 5000}, "ORG2": {"filtered_collated_read_num": 2500}}
+            assert not os.path.exists(f"{fstem}/split_bam.log")
+    shutil.rmtree(fstem)
+    shutil.rmtree(bin_dir)
+
+
 if __name__ == "__main__":
     for i in ["./data/eval/agg_refs.fasta", None]:
         init_consensus(infile=i)
@@ -0,0 +1,43 @@
+import os
+import time
+import shutil
+
+from test.utils import make_rand_dir
+from app.utils.file_cache import FileCache, content_hash
+
+
+def test_content_hash():
+    '''Stable, and sensitive to part boundaries'''
+    assert content_hash("ab", "c") == content_hash("ab", "c")
+    assert content_hash("ab", "c") != content_hash("a", "bc")
+
+
+def test_file_cache():
+    fstem = make_rand_dir()
+    src = f"{fstem}/src.foo"
+    with open(src, "w") as f:
+        f.write("ACGT" * 256)
+    size_mb = os.path.getsize(src) / (1024 * 1024)
+    '''Miss, then hit after put'''
+    cache = FileCache(f"{fstem}/cache", size_mb * 2.5)
+    assert cache.get("a") is None
+    cache.put("a", src)
+    assert cache.get("a") == cache.path("a")
+    '''Bounded: oldest untouched entry evicted first'''
+    cache.put("b", src)
+    time.sleep(0.01)
+    cache.get("a")
+    cache.put("c", src)
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    '''Disabled cache never stores'''
+    cache = FileCache(f"{fstem}/cache_off", 0)
+    cache.put("a", src)
+    assert cache.get("a") is None
+    assert not os.path.exists(f"{fstem}/cache_off")
+    shutil.rmtree(fstem)
+
+
+if __name__ == "__main__":
+    test_content_hash()
+    test_file_cache()
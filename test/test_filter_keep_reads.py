@@ -2,6 +2,9 @@ import pytest
 import os
 import shutil
 
+import gzip
+import stat
+
 from test.utils import get_random_str, make_rand_dir, create_test_file, get_default_args
 from app.src.filter_keep_reads import FilterKeepReads
 from app.src.preprocess import run_kraken
@@ -58,3 +61,104 @@ def test_filter_keep_reads_noprefilter():
 def test_filter_keep_reads_prefilter():
     '''Should remove 1 human synthetic read from dummy data'''
     run_prefilter(prefilter=True)
+
+
+FAKE_KRAKEN = """#!/bin/bash
+# Stand-in for kraken2 honouring its --output semantics: "-" suppresses per-read output, none means stdout
+out=/dev/stdout
+while [ $# -gt 0 ]; do
+    case $1 in
+        --output) out=$2; shift;;
+        --report) report=$2; shift;;
+    esac
+    shift
+done
+echo "Loading database information... done." >&2
+echo "report" > $report
+[ "$out" == "-" ] && exit 0
+echo -e "C\t{}\t9606\t150\t9606:116" > $out
+"""
+
+
+def test_filter_keep_reads_kraken_stream(monkeypatch):
+    '''Exclusions are built from Kraken2 output streamed on stdout'''
+    p = get_default_args()
+    p.update({"DoKrakenPrefilter": True, "KrakenStream": True,
+              "SingleEndedReads": False, "ExcludeNames": "", "RetainNames": ""})
+    fstem = f'{p["SaveDir"]}/{p["ExpName"]}'
+    if os.path.exists(fstem):
+        shutil.rmtree(fstem)
+    os.mkdir(fstem)
+    bin_dir = make_rand_dir()
+    with gzip.open(enumerate_read_files(p["ExpDir"], False)[0], "rt") as f:
+        human_read = f.readline()[1:].split("/")[0].split()[0]
+    with open(f"{bin_dir}/kraken2", "w") as f:
+        f.write(FAKE_KRAKEN.format(human_read))
+    os.chmod(f"{bin_dir}/kraken2", stat.S_IRWXU)
+    monkeypatch.setenv("PATH", f"{os.path.abspath(bin_dir)}:{os.environ['PATH']}")
+    clf = FilterKeepReads(p)
+    clf.main()
+    assert len(clf.reads_to_exclude) == 1
+    assert human_read in clf.reads_to_exclude
+    assert clf.num_reads[0] == clf.num_reads[1]
+    shutil.rmtree(fstem)
+    shutil.rmtree(bin_dir)
+
+
+def test_filter_keep_reads_compressor_fails(monkeypatch):
+    '''A failed compressor leaves an incomplete intermediate, so must stop the run'''
+    p = get_default_args()
+    p.update({"DoKrakenPrefilter": False, "IntermediateCompression": True, "SingleEndedReads": False})
+    fstem = f'{p["SaveDir"]}/{p["ExpName"]}'
+    if os.path.exists(fstem):
+        shutil.rmtree(fstem)
+    os.mkdir(fstem)
+    clf = FilterKeepReads(p)
+    clf.main()
+    assert clf.num_reads[0] == clf.num_reads[1] > 0
+    monkeypatch.setattr("app.src.filter_keep_reads.compress_cmd",
+                        lambda n_threads: "head -c 10 > /dev/null; exit 1")
+    with pytest.raises(SystemError):
+        FilterKeepReads(p).main()
+    '''Compressor exiting cleanly part way through still leaves an incomplete file'''
+    monkeypatch.setattr("app.src.filter_keep_reads.compress_cmd",
+                        lambda n_threads: "head -c 10 > /dev/null; exit 0")
+    with pytest.raises(SystemError):
+        FilterKeepReads(p).main()
+    shutil.rmtree(fstem)
+
+
+def test_filter_keep_reads_prescreen_single_ended():
+    '''Single ended reads are screened while filtering, keeping the same reads as the paired reads' extra screening pass'''
+    p = get_default_args()
+    p.update({"DoKrakenPrefilter": False, "SingleEndedReads": True, "KmerPrescreen": True, "PrescreenMinKmers": 2})
+    p["SaveDir"], p["ExpDir"] = make_rand_dir(), make_rand_dir()
+    os.mkdir(f'{p["SaveDir"]}/{p["ExpName"]}')
+    shutil.copy(enumerate_read_files("./data/eval/", False)[0], f"{p['ExpDir']}/r.fastq.gz")
+    clf = FilterKeepReads(p)
+    clf.main()
+    assert clf.prescreen is None and clf.panel is not None
+    expected = clf.screen_file(clf.a["input_file"][0], clf.panel)
+    assert clf.num_prescreened == clf.num_reads[0] == expected.sum()
+    assert 0 < clf.num_reads[0] < len(expected)
+    shutil.rmtree(p["SaveDir"])
+    shutil.rmtree(p["ExpDir"])
+
+
+def test_filter_keep_reads_unpaired():
+    '''R1 and R2 must give the same counts, else pairs are broken'''
+    p = get_default_args()
+    p.update({"DoKrakenPrefilter": False, "SingleEndedReads": False})
+    fstem = f'{p["SaveDir"]}/{p["ExpName"]}'
+    if os.path.exists(fstem):
+        shutil.rmtree(fstem)
+    os.mkdir(fstem)
+    p["ExpDir"] = make_rand_dir()
+    r1, r2 = enumerate_read_files("./data/eval/", False)
+    shutil.copy(r1, f"{p['ExpDir']}/r_1.fastq.gz")
+    with gzip.open(r2, "rt") as f_in, gzip.open(f"{p['ExpDir']}/r_2.fastq.gz", "wt") as f_out:
+        f_out.write("".join(f_in.readlines()[4:]))
+    with pytest.raises(SystemError):
+        FilterKeepReads(p).main()
+    shutil.rmtree(fstem)
+    shutil.rmtree(p["ExpDir"])
@@ -0,0 +1,36 @@
+import random
+
+from app.utils.identity_clustering import cluster_by_identity, kmer_sketch, sketch_jaccard
+
+
+def mutate(seq, n):
+    seq = list(seq)
+    for i in random.sample(range(len(seq)), n):
+        seq[i] = {"A": "C", "C": "G", "G": "T", "T": "A"}[seq[i]]
+    return "".join(seq)
+
+
+def test_sketch_jaccard():
+    random.seed(1)
+    seq = "".join(random.choice("ACGT") for _ in range(200))
+    a, b = kmer_sketch(seq, 11, 64), kmer_sketch(mutate(seq, 100), 11, 64)
+    assert sketch_jaccard(a, a, 64) == 1.0
+    assert sketch_jaccard(a, b, 64) < 0.2
+
+
+def test_cluster_by_identity():
+    random.seed(1)
+    seq_a = "".join(random.choice("ACGT") for _ in range(200))
+    seq_b = "".join(random.choice("ACGT") for _ in range(200))
+    '''[seq, id, count], most abundant first'''
+    seqs = [[seq_a, "a0", 10], [seq_b, "b0", 5], [mutate(seq_a, 2), "a1", 3],
+            [mutate(seq_b, 3), "b1", 2], [mutate(seq_a, 40), "c0", 1]]
+    reps, memberships = cluster_by_identity(seqs, 0.97, 11)
+    assert [i[1:] for i in reps] == [["a0", 13, 2], ["b0", 7, 2], ["c0", 1, 1]]
+    assert [i[2] for i in memberships] == ["a0", "b0", "a0", "b0", "c0"]
+    assert memberships[2][3] == 0.99
+
+
+if __name__ == "__main__":
+    test_sketch_jaccard()
+    test_cluster_by_identity()
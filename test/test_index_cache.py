@@ -0,0 +1,52 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from test.utils import make_rand_dir
+import pytest
+
+from app.utils.index_cache import IndexCache
+from app.utils.mapper_profiles import index_files
+
+
+class CountingIndexCache(IndexCache):
+    '''Stand-in build command that records each build, so reuse can be checked without mapper installed'''
+
+    def build_cmd(self) -> str:
+        return f"echo built >> {self.root}/builds.txt; touch {' '.join(index_files('bwa', f'{self.entry}/ref.fa'))}"
+
+
+class FailingIndexCache(IndexCache):
+    def build_cmd(self) -> str:
+        return f"touch {self.entry}/ref.fa.amb; exit 1"
+
+
+def test_index_cache():
+    fstem = make_rand_dir()
+    ref = f"{fstem}/ref.fa"
+    with open(ref, "w") as f:
+        f.write(">a\nACGTACGT\n")
+    p = {"SaveDir": fstem, "RefStem": ref, "Mapper": "bwa",
+         "SingleEndedReads": False, "NThreads": 1}
+    '''Concurrent samples build once and share one index'''
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        out = list(pool.map(lambda _: CountingIndexCache(p).get(), range(4)))
+    assert len(set([i[0] for i in out])) == 1
+    assert os.path.exists(f"{out[0][0]}.bwt.2bit.64")
+    assert open(f"{CountingIndexCache(p).root}/builds.txt").read() == "built\n"
+    '''Key changes with reference content and mapper'''
+    assert CountingIndexCache({**p, "Mapper": "minimap2"}).key != CountingIndexCache(p).key
+    with open(ref, "a") as f:
+        f.write(">b\nTTTT\n")
+    assert CountingIndexCache(p).key != os.path.basename(os.path.dirname(out[0][0]))
+    '''Interrupted build (no log) is redone'''
+    cache = CountingIndexCache(p)
+    os.makedirs(cache.entry)
+    cache.get()
+    assert open(f"{cache.root}/builds.txt").read() == "built\nbuilt\n"
+    '''Failed build is not cached'''
+    failing = FailingIndexCache({**p, "Mapper": "bowtie2"})
+    with pytest.raises(SystemError):
+        failing.get()
+    assert not os.path.exists(failing.entry)
+    shutil.rmtree(fstem)
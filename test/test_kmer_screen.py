@@ -0,0 +1,45 @@
+import os
+import random
+import shutil
+
+from test.utils import make_rand_dir
+from app.utils.kmer_screen import canonical_kmers, KmerPanel
+
+COMP = {"A": "T", "C": "G", "G": "C", "T": "A"}
+
+
+def naive_canonical_kmers(seq, k):
+    out = []
+    for i in range(len(seq) - k + 1):
+        kmer = seq[i:i + k].upper()
+        if any([j not in COMP.keys() for j in kmer]):
+            continue
+        rc = "".join([COMP[j] for j in kmer[::-1]])
+        out.append(min([int("".join([str("ACGT".index(j)) for j in x]), 4) for x in [kmer, rc]]))
+    return out
+
+
+def test_canonical_kmers():
+    random.seed(1)
+    seqs = ["".join(random.choices("ACGTN", weights=[10, 10, 10, 10, 1], k=random.randint(0, 60))) for _ in range(50)]
+    kmers, seq_idx = canonical_kmers(seqs, 7)
+    for i, seq in enumerate(seqs):
+        assert [int(j) for j in kmers[seq_idx == i]] == naive_canonical_kmers(seq, 7)
+    '''Strand agnostic'''
+    assert canonical_kmers(["AACGTTTGCA"], 5)[0].tolist() == canonical_kmers(["TGCAAACGTT"], 5)[0][::-1].tolist()
+
+
+def test_kmer_panel():
+    fstem = make_rand_dir()
+    random.seed(2)
+    target = "".join(random.choices("ACGT", k=300))
+    with open(f"{fstem}/ref.fa", "w") as f:
+        f.write(f">target\n{target}\n")
+    p = {"SaveDir": fstem, "RefStem": f"{fstem}/ref.fa"}
+    panel = KmerPanel(p).load()
+    assert os.path.exists(panel.fname)
+    on_target = target[50:150]
+    rev_comp = "".join([COMP[i] for i in on_target[::-1]])
+    off_target = "".join(random.choices("ACGT", k=100))
+    assert panel.screen([on_target, rev_comp, off_target, ""], 2).tolist() == [True, True, False, False]
+    shutil.rmtree(fstem)
@@ -0,0 +1,30 @@
+import os
+import shutil
+
+from test.utils import get_random_str
+from app.utils.lineage_index import LineageIndex
+
+LINEAGE = ["tax_id,superkingdom,phylum,class,order,family,genus,species,cladeX\n",
+           "9606,Eukaryota,Chordata,Mammalia,Primates,Hominidae,Homo,Homo sapiens,\n",
+           "63221,Eukaryota,Chordata,Mammalia,Primates,Hominidae,Homo,Homo sapiens neanderthalensis,\n",
+           "9598,Eukaryota,Chordata,Mammalia,Primates,Hominidae,Pan,Pan troglodytes,\n",
+           "10090,Eukaryota,Chordata,Mammalia,Rodentia,Muridae,Mus,Mus musculus,Homo\n"]
+
+
+def test_lineage_index():
+    fname = f"./test/{get_random_str()}.csv"
+    with open(fname, "w") as f:
+        [f.write(i) for i in LINEAGE]
+    clf = LineageIndex(fname).load()
+    assert os.path.exists(f"{clf.index_dir}/names.npy")
+    '''Same taxids as substring search for ",{name},"'''
+    for name in ["Homo", "Hominidae", "Pan troglodytes", "Chordata", "Mus musculus", "Pan tro", "9606"]:
+        expected = [i.split(",", 1)[0] for i in LINEAGE if f",{name}," in i]
+        assert sorted(clf.lookup(name)) == sorted(expected)
+    assert clf.lookup("Homo") == ["9606", "63221"]
+    '''Reload uses existing index'''
+    mtime = os.path.getmtime(clf.index_dir)
+    assert LineageIndex(fname).load().lookup("Pan") == ["9598"]
+    assert os.path.getmtime(clf.index_dir) == mtime
+    shutil.rmtree(clf.index_dir)
+    os.remove(fname)
@@ -41,6 +41,9 @@ def init_run_map(do_preprocessing, fake_files=False):
                 assert not os.path.exists(
                     f"rm {p['SaveDir']}/{p['ExpName']}/{p['ExpName']}_1_clean.fastq")
         shutil.rmtree(fstem)
+    '''Mapping indices are cached in SaveDir, shared by every mapper run above'''
+    if os.path.exists(f"{p['SaveDir']}/castanet_cache/mapping_indices"):
+        shutil.rmtree(f"{p['SaveDir']}/castanet_cache/mapping_indices")
 
 
 def test_map_no_preprocessing():
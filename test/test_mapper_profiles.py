@@ -0,0 +1,26 @@
+from app.utils.mapper_profiles import MAPPER_PROFILES, thread_budget, sort_mem_mb, map_to_bam_cmd, index_cmd, index_path, SORT_MEM_MB
+
+
+def test_thread_budget():
+    '''Above 2 threads, never more than NThreads in total (samtools -@ being extra to its main thread); mapper always gets 1'''
+    for n in [3, 7, 8, 16, 64]:
+        threads = thread_budget(n)
+        assert threads["mapper"] >= 1
+        assert threads["mapper"] + (threads["view"] + 1) + (threads["sort"] + 1) == n
+    assert thread_budget(1) == {"mapper": 1, "view": 0, "sort": 0}
+    assert thread_budget(2) == {"mapper": 2, "view": 0, "sort": 0}
+    assert thread_budget(16) == {"mapper": 10, "view": 2, "sort": 2}
+    assert 64 <= sort_mem_mb(8) <= SORT_MEM_MB
+
+
+def test_map_to_bam_cmd():
+    for mapper in MAPPER_PROFILES.keys():
+        cmd = map_to_bam_cmd(mapper, index_path(mapper, "ref.fa"), ["r1.fq", "r2.fq"], "out.bam", 16, "tmp/sort")
+        assert "r1.fq" in cmd and "r2.fq" in cmd
+        assert "-t 10 " in cmd or "-p 10 " in cmd
+        assert "samtools view -@ 2" in cmd
+        assert "samtools sort -@ 2 -m" in cmd and "-T tmp/sort" in cmd
+        assert cmd.endswith("1> out.bam")
+    '''Minimap2 index preset matches mapping preset'''
+    assert "map-ont" in index_cmd("minimap2", "ref.fa", 1, True)
+    assert "map-ont" not in index_cmd("minimap2", "ref.fa", 1, False)
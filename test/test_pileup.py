@@ -0,0 +1,65 @@
+import os
+import numpy as np
+
+from test.utils import get_random_str
+from app.utils.pileup import TargetPileup, PILEUP_COLS, save_pileups, load_pileups
+
+'''chrom, pos, ref, depth, bases, quals (mpileup without reference: literal bases)'''
+MPILEUP = ["tar\t1\tN\t0\t\t\n",
+           "tar\t2\tN\t3\t^IA^IA^5a\tIII\n",
+           "tar\t3\tN\t3\tC+2GTc+2gtG\tIII\n",
+           "tar\t4\tN\t3\tT-1Ntt\tIII\n",
+           "tar\t5\tN\t3\t*A*\tIII\n",
+           "tar\t6\tN\t1\tG$\tI\n",
+           "tar\t7\tN\t0\t\t\n"]
+
+
+def test_parse():
+    pileup = TargetPileup("tar").parse(MPILEUP)
+    assert pileup.counts.shape == (7, len(PILEUP_COLS))
+    assert pileup.counts[1].tolist() == [3, 0, 0, 0, 0, 0]
+    assert pileup.counts[2].tolist() == [0, 2, 1, 0, 0, 0]
+    assert pileup.counts[4].tolist() == [1, 0, 0, 0, 2, 0]
+    assert pileup.insertions[2] == ["GT", "GT"]
+    assert pileup.read_mapqs == [40, 40, 20]
+    assert pileup.depth().tolist() == [0, 3, 3, 3, 1, 1, 0]
+
+
+def test_coverage():
+    row = TargetPileup("tar").parse(MPILEUP).coverage()
+    assert row[0:5] == ["tar", 1, 7, 3, 5]
+    assert np.isclose(row[5], 5 / 7 * 100) and np.isclose(row[6], 11 / 7)
+    assert np.isclose(row[8], 100 / 3)
+
+
+def test_consensus():
+    pileup = TargetPileup("tar").parse(MPILEUP)
+    '''Ends trimmed, deletion dropped, majority insertion added, low depth N'''
+    assert pileup.consensus(2) == "ACGTTN"
+    '''Reference coordinates'''
+    assert pileup.consensus(2, reference_coords=True) == "NACT*NN"
+    assert TargetPileup("empty").consensus(2) == ""
+    '''Internal uncovered positions skipped, as samtools consensus without -a'''
+    gapped = TargetPileup("tar").parse(MPILEUP[0:3] + MPILEUP[6:7] + MPILEUP[1:2])
+    assert gapped.consensus(2) == "ACGTA"
+    assert gapped.consensus(2, reference_coords=True) == "NACNA"
+    '''All N position has no calling depth, so is N whatever min_d, but still covered (not skipped)'''
+    all_n = TargetPileup("tar").parse(["tar\t1\tA\t3\t...\tIII\n", "tar\t2\tC\t3\tNNN\tIII\n", "tar\t3\tG\t3\t...\tIII\n"])
+    assert all_n.consensus(2) == "ANG"
+    assert all_n.consensus(0) == "ANG"
+    assert all_n.consensus(2, reference_coords=True) == "ANG"
+
+
+def test_save_load_pileups():
+    fname = f"./test/{get_random_str()}.npz"
+    pileup = TargetPileup("tar").parse(MPILEUP)
+    save_pileups(fname, {"tar": pileup})
+    assert (load_pileups(fname)["tar"] == pileup.counts).all()
+    os.remove(fname)
+
+
+if __name__ == "__main__":
+    test_parse()
+    test_coverage()
+    test_consensus()
+    test_save_load_pileups()
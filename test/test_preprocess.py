@@ -3,7 +3,7 @@ import os
 import mock
 
 from app.utils.shell_cmds import shell
-from app.src.preprocess import run_kraken, rm_existing_kraken
+from app.src.preprocess import run_kraken, rm_existing_kraken, kraken_cmd
 from test.utils import get_default_args
 
 
@@ -27,3 +27,10 @@ def test_rm_existing_kraken():
     assert not os.path.exists("test/experiments/test/kraken.kraken") or not os.path.exists(
         "test/experiments/test/kraken_report.tsv")
 
+
+def test_kraken_cmd():
+    p = get_default_args()
+    p["SeqNames"] = ["r_1.fq", "r_2.fq"]
+    assert "--output out.kraken " in kraken_cmd(p, "out.kraken")
+    '''Streamed per-read output goes to Kraken2's default, stdout: "--output -" would suppress it'''
+    assert "--output" not in kraken_cmd(p)
@@ -0,0 +1,21 @@
+import os
+import shutil
+
+from test.utils import get_random_str, get_default_args
+from app.utils.read_counts import record_read_count, get_read_counts, read_counts_fname
+
+
+def test_record_read_count():
+    p = get_default_args()
+    p["ExpName"] = get_random_str()
+    os.mkdir(f"{p['SaveDir']}/{p['ExpName']}")
+    assert get_read_counts(p) == {}
+    record_read_count(p, "post_trim", 80)
+    record_read_count(p, "raw", 100)
+    record_read_count(p, "post_filter", 90)
+    record_read_count(p, "post_trim", 85)
+    assert get_read_counts(p) == {"raw": 100, "post_filter": 90, "post_trim": 85}
+    '''Saved in pipeline order'''
+    with open(read_counts_fname(p)) as f:
+        assert [i.split(",")[0] for i in f.read().split()] == ["stage", "raw", "post_filter", "post_trim"]
+    shutil.rmtree(f"{p['SaveDir']}/{p['ExpName']}")
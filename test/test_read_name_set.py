@@ -0,0 +1,28 @@
+import numpy as np
+
+from test.utils import get_random_str
+from app.utils.read_name_set import ReadNameSet
+
+
+def test_read_name_set():
+    names = [get_random_str() for _ in range(1000)]
+    clf = ReadNameSet()
+    for name in names[0:500] + names[0:10]:
+        clf.add(name)
+    '''Nothing is searchable until frozen'''
+    assert len(clf) == 0
+    clf.freeze()
+    assert len(clf) == 500
+    assert names[0] in clf
+    assert not names[999] in clf
+    mask = clf.contains(names)
+    assert mask[0:500].all()
+    assert not mask[500:].any()
+    assert mask.dtype == np.bool_
+
+
+def test_read_name_set_empty():
+    clf = ReadNameSet().freeze()
+    assert not clf
+    assert not "read1" in clf
+    assert clf.contains(["read1", "read2"]).tolist() == [False, False]
@@ -0,0 +1,16 @@
+import os
+import stat
+
+from test.utils import get_random_str
+from app.src.stream_pipeline import make_fifos
+
+
+def test_make_fifos():
+    fnames = [f"./test/{get_random_str()}_filt.fastq" for _ in range(2)]
+    '''Stale regular files from a previous run are replaced'''
+    with open(fnames[0], "w") as f:
+        f.write("@read\n")
+    make_fifos(fnames)
+    for fname in fnames:
+        assert stat.S_ISFIFO(os.stat(fname).st_mode)
+        os.remove(fname)
@@ -3,7 +3,7 @@ import os
 import shutil
 
 from test.utils import get_random_str, make_rand_dir, create_test_file, get_default_args
-from app.src.trim_adapters import run_trim
+from app.src.trim_adapters import run_trim, trimmed_read_num
 from app.src.filter_keep_reads import FilterKeepReads
 from app.src.preprocess import run_kraken
 
@@ -51,3 +51,11 @@ def test_trim_adapters_pipelinentry_dotrim():
 def test_trim_adapters_pipelinentry_donttrim():
     '''With prior kraken run, with trimming set to true'''
     init_do_trim(do_trim=False, entry_via_pipelne=True)
+
+
+def test_trimmed_read_num():
+    pe_log = "TrimmomaticPE: Started with arguments:\nInput Read Pairs: 1000 Both Surviving: 950 (95.00%) Forward Only Surviving: 20 (2.00%) Reverse Only Surviving: 10 (1.00%) Dropped: 20 (2.00%)\nTrimmomaticPE: Completed successfully"
+    se_log = "TrimmomaticSE: Started with arguments:\nInput Reads: 1000 Surviving: 900 (90.00%) Dropped: 100 (10.00%)\nTrimmomaticSE: Completed successfully"
+    assert trimmed_read_num(pe_log) == 950
+    assert trimmed_read_num(se_log) == 900
+    assert trimmed_read_num("") is None
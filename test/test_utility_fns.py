@@ -1,10 +1,12 @@
 import pytest
 import os
+import io
 import shutil
 
 from test.utils import get_random_str, make_rand_dir, create_test_file
-from app.utils.utility_fns import (make_exp_dir, get_gene_orgid, read_fa, save_fa,
+from app.utils.utility_fns import (make_exp_dir, get_gene_orgid, read_fa, stream_fa, stream_fastq_blocks, save_fa, compress_cmd, open_intermediate,
                                    trim_long_fpaths, enumerate_bam_files, enumerate_read_files)
+from app.utils.shell_cmds import shell
 
 
 def test_make_exp_dir():
@@ -28,6 +30,42 @@ def test_read_fa():
     assert len(fa) == 1 and fa[0][0][0] == ">" and fa[0][1][0] == "G"
 
 
+def test_stream_fa():
+    fa = [[">seq1", "ATCG\nATCG"], [">seq2", "ATCG"]]
+    fa_fname = f"./test/{get_random_str()}.fasta"
+    with open(fa_fname, "w") as f:
+        [f.write(f"{i[0]}\n{i[1]}\n") for i in fa]
+    fa_read = list(stream_fa(fa_fname))
+    assert fa_read == [[">seq1", "ATCGATCG"], [">seq2", "ATCG"]]
+    assert fa_read[0] == read_fa(fa_fname)[0]
+    os.remove(fa_fname)
+
+
+def test_stream_fastq_blocks():
+    fq = "".join([f"@read{i}\n{'ATCG' * (i + 1)}\n+\n{'I' * 4 * (i + 1)}\n" for i in range(20)])
+    for block_size in [1, 9, 100, 10000]:
+        lines = [l for block in stream_fastq_blocks(
+            io.BytesIO(fq.encode()), block_size) for l in block]
+        assert len(lines) == 80
+        assert "".join([f"{l}\n" for l in lines]) == fq
+    '''No trailing newline'''
+    lines = [l for block in stream_fastq_blocks(
+        io.BytesIO(fq[:-1].encode()), 9) for l in block]
+    assert lines[-1] == "I" * 80
+
+
+def test_open_intermediate():
+    fstem = f"./test/{get_random_str()}"
+    text = "read1\tchr1\t100\nread2\tchr1\t200\n"
+    with open(f"{fstem}.txt", "w") as f:
+        f.write(text)
+    shell(f"cat {fstem}.txt | {compress_cmd(2)} > {fstem}.txt.gz")
+    for fname in [f"{fstem}.txt", f"{fstem}.txt.gz"]:
+        with open_intermediate(fname) as f:
+            assert f.read() == text
+        os.remove(fname)
+
+
 def test_save_fa():
     fa = [[">seq1", "ATCG"], [">seq2", "ATCG"]]
     fa_fname = f"./test/{get_random_str()}.fasta"
@@ -28,11 +28,15 @@ def get_default_args():
         "RefStem": "data/eval/ref.fa",
         "MappingRefTable": "",
         "Mapper": "bwa",
+        "StreamPipeline": False,
         "SingleEndedReads": False,
         "MatchLength": 40,
         "DoTrimming": True,
         "TrimMinLen": 36,
         "DoKrakenPrefilter": True,
+        "KrakenStream": False,
+        "KmerPrescreen": False,
+        "PrescreenMinKmers": 2,
         "LineageFile": "data/ncbi_lineages_2023-06-15.csv.gz",
         "ExcludeIds": "9606",
         "RetainIds": "",
@@ -43,6 +47,10 @@ def get_default_args():
         "ConsensusCoverage": 30,
         "ConsensusMapQ": 1,
         "ConsensusTrimTerminals": True,
+        "ConsensusRefAlnCacheMB": 1024,
+        "ConsensusMaxDepth": 0,
+        "ConsensusProjection": False,
+        "ConsensusProjectionMaxDivergence": 0.1,
         "GtFile": "",
         "GtOrg": "",
         "KrakenDbDir": "kraken2_human_db/",
@@ -51,5 +59,6 @@ def get_default_args():
         "AdaptP": "data/all_adapters.fa",
         "NThreads": os.cpu_count() - 1,
         "SeqNames": ["data/eval/sim_reads_1.fastq.gz", "data/eval/sim_reads_2.fastq.gz"],
+        "IntermediateCompression": False,
         "DebugMode": True
     }